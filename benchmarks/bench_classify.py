@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试：spine很长的书的manifest分类
+
+生成有N个章节和N个资源的content.opf，分别计时解析OPF、classify_manifest，
+以及原先对spine列表逐项判断成员的写法。章节数翻倍时classify_manifest的耗时应大致翻倍（线性），
+列表写法则约为四倍。
+
+用法: python benchmarks/bench_classify.py [章节数 ...]（默认 1250 2500 5000 10000）
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epub_merger import EpubMerger  # noqa: E402
+
+
+def build_opf(chapters: int) -> bytes:
+    """生成有chapters个章节、每章一张图片的content.opf"""
+    items = []
+    itemrefs = []
+    for i in range(chapters):
+        items.append(f'<item id="c{i}" href="Text/c{i}.xhtml" media-type="application/xhtml+xml"/>')
+        items.append(f'<item id="img{i}" href="Images/p{i}.jpg" media-type="image/jpeg"/>')
+        itemrefs.append(f'<itemref idref="c{i}"/>')
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>bench</dc:title></metadata>
+<manifest>{''.join(items)}</manifest>
+<spine>{''.join(itemrefs)}</spine>
+</package>'''.encode('utf-8')
+
+
+def classify_with_list(spine, manifest):
+    """原先的写法：对spine列表判断成员，O(manifest × spine)"""
+    return [item_id for item_id in manifest if item_id not in spine]
+
+
+def best_of(func, *args, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    sizes = [int(arg) for arg in (argv if argv is not None else sys.argv[1:])] or [1250, 2500, 5000, 10000]
+    merger = EpubMerger()
+    print(f"{'章节数':>8} {'解析OPF':>10} {'集合分类':>10} {'列表分类':>10}")
+    for chapters in sizes:
+        opf = build_opf(chapters)
+        parse_time = best_of(lambda: merger.parse_content_opf(io.BytesIO(opf)))
+        spine, manifest, metadata = merger.parse_content_opf(io.BytesIO(opf))
+        resources = merger.classify_manifest(spine, manifest)
+        assert resources == classify_with_list(spine, manifest)
+        assert len(resources) == chapters
+        set_time = best_of(merger.classify_manifest, spine, manifest)
+        list_time = best_of(classify_with_list, spine, manifest, repeat=1)
+        print(f"{chapters:>8} {parse_time * 1000:>8.1f}ms {set_time * 1000:>8.2f}ms {list_time * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
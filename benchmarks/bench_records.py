@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试：manifest条目和输出条目的内存占用
+
+用tracemalloc分别统计N个条目用字典（原先的写法）和用带__slots__的ManifestItem/OutputItem时新分配的内存。
+href字符串事先创建、两种写法共用，不计入结果；media-type每个条目各自生成一份（和XML解析器一样），
+ManifestItem会把它驻留为同一个对象。
+
+用法: python benchmarks/bench_records.py [条目数]（默认 100000）
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epub_merger import ManifestItem, OutputItem  # noqa: E402
+
+MEDIA_TYPES = ('application/xhtml+xml', 'image/jpeg', 'image/png', 'text/css')
+
+
+def media_type(index: int) -> str:
+    # 每次都得到新的字符串对象，模拟解析器为每个属性值分配的字符串
+    return ''.join(MEDIA_TYPES[index % len(MEDIA_TYPES)])
+
+
+def measure(build, count: int) -> int:
+    """返回build(count)返回的对象所占用的新分配内存（字节）"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = build(count)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del records
+    return used
+
+
+def main(argv=None):
+    args = argv if argv is not None else sys.argv[1:]
+    count = int(args[0]) if args else 100000
+    hrefs = [f'Images/picture_{i}.jpg' for i in range(count)]
+    new_hrefs = [f'resources/picture_{i}.jpg' for i in range(count)]
+    
+    cases = [
+        ('manifest 字典', lambda n: {f'i{i}': {'href': hrefs[i], 'media-type': media_type(i), 'properties': ''}
+                                      for i in range(n)}),
+        ('manifest ManifestItem', lambda n: {f'i{i}': ManifestItem(hrefs[i], media_type(i), '')
+                                              for i in range(n)}),
+        ('输出条目 字典', lambda n: {f'item_{i:04d}': {'href': new_hrefs[i], 'media_type': media_type(i),
+                                                    'original_href': hrefs[i]} for i in range(n)}),
+        ('输出条目 OutputItem', lambda n: {f'item_{i:04d}': OutputItem(new_hrefs[i], sys.intern(media_type(i)),
+                                                                      hrefs[i]) for i in range(n)}),
+    ]
+    results = {}
+    for name, build in cases:
+        results[name] = measure(build, count)
+        print(f"{name:<24} {results[name] / 1048576:8.1f} MB  {results[name] / count:6.0f} 字节/条")
+    
+    # 两种写法的差值就是每个条目本身节省的内存（ID字符串和外层字典两边相同）
+    for kind, old, new in (('manifest', 'manifest 字典', 'manifest ManifestItem'),
+                           ('输出条目', '输出条目 字典', '输出条目 OutputItem')):
+        print(f"{kind}: 每条节省 {(results[old] - results[new]) / count:.0f} 字节 "
+              f"({(1 - results[new] / results[old]) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
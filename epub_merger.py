@@ -3,161 +3,1499 @@
 """
 EPUB文件合并工具
 将多个EPUB文件按顺序合并成一个文件，保留原有的图片和文字，保持原有的顺序和位置
+
+为了让命令行快速启动，只在模块顶层导入合并本身必需的模块；
+zipfile、argparse、hashlib、uuid、datetime等只在用到的地方才导入。
 """
 
+import itertools
 import os
-import zipfile
-import xml.etree.ElementTree as ET
-from pathlib import Path
-import shutil
-import tempfile
-from typing import List, Dict, Tuple
-import argparse
+import posixpath
+import queue
+import threading
+import xml.parsers.expat
+from typing import List, Dict, Tuple, Callable
 import logging
 import re
-import urllib.parse
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+__version__ = '2.3.0'
 
-# 设置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 超过该值的大小和偏移需要使用ZIP64扩展
+ZIP64_LIMIT = 0xFFFFFFFF
+# ZIP压缩方式（与zipfile中的常量相同，避免启动时就导入zipfile）
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# 本地文件头的固定部分
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+# 合并时需要改写引用的资源类型，其他资源原样写出
+REWRITTEN_MEDIA_TYPES = ('text/css', 'application/xhtml+xml')
+# 嵌入字体的媒体类型和扩展名
+FONT_MEDIA_TYPES = ('application/x-font-ttf', 'application/x-font-truetype', 'application/x-font-otf',
+                    'application/font-sfnt', 'application/vnd.ms-opentype', 'application/font-woff',
+                    'font/ttf', 'font/otf', 'font/sfnt', 'font/woff', 'font/woff2')
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+# 带协议（http:、mailto:、data:等）或以//开头的外部引用，不改写
+EXTERNAL_REFERENCE = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:|//')
+# HTML中的src和href属性：等号两边允许空白，引号必须成对（双引号的值中可以有单引号，反之亦然）
+HTML_REFERENCE = re.compile(r'(?<![\w-])(src|href)(\s*=\s*)(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+# CSS的url()：引号内的地址可以有空白和括号，不加引号的地址到空白或右括号为止；
+# 地址后的空白放在各分支内，空的url()单独一个分支，url(后跟大量空白时回溯不会退化为平方时间
+CSS_URL = re.compile(r'url\(\s*(?:"([^"]*)"\s*|\'([^\']*)\'\s*|([^"\'()\s]+)\s*|)\)', re.IGNORECASE)
+# CSS词法单元：字符串、注释、括号和分隔符、空白、其他文本
+CSS_TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?(?:\*/|$)|[{}();]|\s+|[^"\'/{}();\s]+|/',
+                       re.DOTALL)
+
+class ManifestItem:
+    """输入书manifest中的一项"""
+    __slots__ = ('href', 'media_type', 'properties')
+    
+    def __init__(self, href: str, media_type: str, properties: str = ''):
+        self.href = href
+        # media-type的取值很少，驻留后所有条目共享同一个字符串对象
+        self.media_type = sys.intern(media_type) if media_type else media_type
+        self.properties = properties
+
+
+class OutputItem:
+    """合并后输出的一项：资源文件、改写后的spine文档或生成的导航文档"""
+    __slots__ = ('href', 'media_type', 'original_href', 'properties')
+    
+    def __init__(self, href: str, media_type: str, original_href: str, properties: str = ''):
+        self.href = href
+        self.media_type = media_type
+        self.original_href = original_href
+        self.properties = properties
+
+
+class BookData:
+    """预读到内存中的一本输入书"""
+    __slots__ = ('index', 'path', 'opf_name', 'spine', 'manifest', 'metadata', 'members', 'size',
+                 'compressed_size')
+    
+    def __init__(self, index: int, path: str, opf_name: str, spine: List[str], manifest: Dict,
+                 metadata: Dict, members: Dict[str, bytes], size: int, compressed_size: int = 0):
+        self.index = index
+        self.path = path
+        self.opf_name = opf_name
+        self.spine = spine
+        self.manifest = manifest
+        self.metadata = metadata
+        # manifest中的href -> 解压后的成员数据（bytes或memoryview），原样写出的成员为RawMember
+        self.members = members
+        self.size = size
+        # 成员在输入书中压缩后的大小，用于估算输出大小
+        self.compressed_size = compressed_size
+
+
+def subset_font(data: bytes, unicodes: Tuple[int, ...]) -> bytes:
+    """用fontTools把字体裁剪为只含给定码位的字形，保持原有格式（TTF/OTF/WOFF/WOFF2）
+    
+    在进程池中运行，因此是模块级函数。
+    """
+    import io
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+    
+    font = TTFont(io.BytesIO(data), recalcTimestamp=False)
+    options = subset.Options()
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.notdef_outline = True
+    options.flavor = font.flavor
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=unicodes)
+    subsetter.subset(font)
+    output = io.BytesIO()
+    font.save(output)
+    return output.getvalue()
+
+
+class RawMember:
+    """输入书中不需要改写的成员：直接转发压缩好的原始数据，不解压也不重新压缩"""
+    __slots__ = ('raw', 'crc', 'file_size', 'compress_type')
+    
+    def __init__(self, raw: memoryview, crc: int, file_size: int, compress_type: int):
+        self.raw = raw
+        self.crc = crc
+        self.file_size = file_size
+        self.compress_type = compress_type
+    
+    def __len__(self):
+        return self.file_size
+
+
+def detached(data):
+    """返回不再引用输入书映射的数据：memoryview复制为bytes，RawMember复制其压缩数据"""
+    if isinstance(data, RawMember):
+        return RawMember(bytes(data.raw), data.crc, data.file_size, data.compress_type)
+    return bytes(data)
+
+
+class MappedArchive:
+    """以内存映射方式打开的输入EPUB
+    
+    中央目录仍由zipfile解析，成员数据直接从映射中切片，解压后的数据和原始压缩数据
+    都以memoryview交给调用者，省去zipfile每个成员多次read/seek的开销。
+    mmap不可用时（平台不支持、特殊文件等）退回到zipfile的普通读取。
+    映射不显式关闭：交出去的memoryview可能还在写出队列里，最后一个引用释放时映射随之释放。
+    
+    source也可以是bytes或二进制文件对象：bytes直接切片，不可seek的文件对象先整个读入内存；
+    调用者传入的文件对象不会被关闭。
+    """
+    
+    def __init__(self, source):
+        import zipfile
+        self.view = None
+        self.owned = True
+        if isinstance(source, (str, os.PathLike)):
+            self.file = open(source, 'rb')
+        else:
+            if (not isinstance(source, (bytes, bytearray, memoryview))
+                    and not getattr(source, 'seekable', lambda: False)()):
+                source = source.read()
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                import io
+                self.view = memoryview(source)
+                # bytes对象作为BytesIO的初始值时共用同一块内存，不复制
+                self.file = io.BytesIO(source)
+            else:
+                self.file = source
+                self.owned = False
+        if self.view is None:
+            try:
+                import mmap
+                self.view = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+            except (ImportError, OSError, ValueError, AttributeError):
+                self.view = None
+        try:
+            self.zip_ref = zipfile.ZipFile(self.file)
+        except BaseException:
+            if self.owned:
+                self.file.close()
+            raise
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.zip_ref.close()
+        if self.owned:
+            self.file.close()
+        self.view = None
+    
+    def raw_member(self, info: 'zipfile.ZipInfo') -> RawMember:
+        """返回成员的原始压缩数据，不支持时（无映射、加密或其他压缩方式）返回None"""
+        if self.view is None or info.compress_type not in (ZIP_STORED, ZIP_DEFLATED) or info.flag_bits & 1:
+            return None
+        offset = info.header_offset
+        header = LOCAL_HEADER.unpack_from(self.view, offset)
+        if header[0] != b'PK\x03\x04':
+            import zipfile
+            raise zipfile.BadZipFile(f"Bad magic number for file header: {info.filename!r}")
+        start = offset + LOCAL_HEADER.size + header[-2] + header[-1]
+        return RawMember(self.view[start:start + info.compress_size], info.CRC, info.file_size,
+                         info.compress_type)
+    
+    def read(self, info: 'zipfile.ZipInfo'):
+        """读取并校验成员的解压后数据；未压缩的成员直接返回映射上的memoryview"""
+        member = self.raw_member(info)
+        if member is None:
+            return self.zip_ref.read(info)
+        if member.compress_type == ZIP_STORED:
+            data = member.raw
+        else:
+            data = zlib.decompress(member.raw, -15, max(member.file_size, 1))
+        if zlib.crc32(data) != member.crc:
+            import zipfile
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+        return data
+
+
+class ProcessedBook:
+    """增量合并时记录的一本书的处理结果：写出的成员和处理这本书时合并器状态的改动"""
+    __slots__ = ('path', 'compressed_size', 'members', 'state')
+    
+    def __init__(self, path: str, compressed_size: int, members: List[Tuple], state: Tuple):
+        self.path = path
+        self.compressed_size = compressed_size
+        # (成员路径, RawMember)，按写出顺序，保存的是压缩好的数据
+        self.members = members
+        self.state = state
+
+
+class RecordingWriter:
+    """把成员转交给EpubWriter，同时记录压缩结果供下次合并时重放"""
+    
+    def __init__(self, writer: 'EpubWriter'):
+        self.writer = writer
+        self.members = []
+    
+    def add(self, arcname: str, data, compress: bool = True):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        future = self.writer.add(arcname, data, compress)
+        self.members.append((arcname, len(data), future))
+    
+    def raw_members(self) -> List[Tuple[str, RawMember]]:
+        """返回记录的成员，须在写出完成后调用
+        
+        只保留压缩好的数据，并复制为独立的bytes，不再引用输入书映射上的memoryview，
+        映射随输入书一起释放，输入文件可以被替换；与MergeCache中相同的压缩结果共用同一个对象。
+        """
+        members = []
+        for arcname, file_size, future in self.members:
+            raw, crc, compress_type = future.result()
+            members.append((arcname, RawMember(bytes(raw), crc, file_size, compress_type)))
+        return members
+
+
+class JournalDict(dict):
+    """记录写入和删除的字典：增量合并时用来取出处理一本书期间的改动，不必复制整个字典"""
+    __slots__ = ('changes',)
+    
+    DELETED = object()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changes = {}
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changes[key] = value
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changes[key] = self.DELETED
+    
+    def take_changes(self) -> Dict:
+        """返回上次取出以来的改动（被删除的键对应DELETED）并清空记录"""
+        changes, self.changes = self.changes, {}
+        return changes
+    
+    def apply_changes(self, changes: Dict):
+        """重放take_changes返回的改动，重放的改动不再记录"""
+        for key, value in changes.items():
+            if value is self.DELETED:
+                dict.pop(self, key, None)
+            else:
+                dict.__setitem__(self, key, value)
+
+
+class JournalSet(set):
+    """记录新加入元素的集合（只支持add和update），用法同JournalDict"""
+    __slots__ = ('changes',)
+    
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.changes = set()
+    
+    def add(self, value):
+        set.add(self, value)
+        self.changes.add(value)
+    
+    def update(self, *iterables):
+        for values in iterables:
+            values = set(values)
+            set.update(self, values)
+            self.changes |= values
+    
+    def take_changes(self) -> set:
+        changes, self.changes = self.changes, set()
+        return changes
+    
+    def apply_changes(self, changes: set):
+        set.update(self, changes)
+
+
+class JournalList(list):
+    """只追加的列表，取出上次取出以来追加的元素，用法同JournalDict"""
+    __slots__ = ('mark',)
+    
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.mark = 0
+    
+    def take_changes(self) -> List:
+        changes = self[self.mark:]
+        self.mark = len(self)
+        return changes
+    
+    def apply_changes(self, changes: List):
+        self.extend(changes)
+        self.mark = len(self)
+
+
+class BookPrefetcher:
+    """后台线程预读输入书（解析OPF并解压成员到内存），与当前书的处理重叠进行，迭代时按输入顺序交出
+    
+    workers大于1时多个线程同时读取：先按中央目录得到每本书解压后的大小，从大到小分给空闲的线程
+    （最长处理时间优先），避免最大的书排在最后、只剩一个线程在读。只有一个线程时按输入顺序读取。
+    depth限制已读完等待处理的书数，memory_limit限制已读入但尚未处理完的字节数：
+    空闲的线程只取放得进剩余预算、且给排在它前面还没读的书留有余量的书，大书不会同时解压太多本。
+    排在所有已占用预算的书之前的书超过限制时仍会读入（处理它之前不会有书释放预算），
+    因此单本书超过上限时仍会读入，但不会与排在它前面的书同时占用内存。
+    threaded为False时不启动线程，迭代时在调用线程中依次读取（记录性能时使用）。
+    """
+    
+    def __init__(self, merger: 'EpubMerger', epub_files: List[str], depth: int = 2,
+                 memory_limit: int = 256 * 1024 * 1024, first_index: int = 0, threaded: bool = True,
+                 workers: int = 1):
+        self.merger = merger
+        self.epub_files = list(epub_files)
+        # 第一本书在整个输入列表中的序号
+        self.first_index = first_index
+        self.depth = max(1, depth)
+        self.memory_limit = memory_limit
+        self.workers = max(1, workers)
+        # 每本书（按在epub_files中的位置）估算的解压后大小，用到时才读取中央目录
+        self.sizes = [None] * len(self.epub_files)
+        # 还没开始读的书，按分配顺序排列
+        self.unstarted = list(range(len(self.epub_files)))
+        if self.workers > 1:
+            self.unstarted.sort(key=lambda position: -self.size_of(position))
+        # 已读完等待交出的书（或读取时的异常）：位置 -> BookData
+        self.ready = {}
+        # 占用内存预算的书：位置 -> 占用的字节数
+        self.reserved = {}
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = []
+        if threaded:
+            for number in range(min(self.workers, len(self.epub_files))):
+                thread = threading.Thread(target=self._run, name=f'epub-prefetch-{number}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def size_of(self, position: int) -> int:
+        if self.sizes[position] is None:
+            self.sizes[position] = self.merger.input_size(self.epub_files[position])
+        return self.sizes[position]
+    
+    def _next(self):
+        """选出下一本要读的书并按估算的大小占用预算，暂时不能读时返回None（持有condition时调用）"""
+        if len(self.ready) < self.depth:
+            if self.workers == 1:
+                position = self.unstarted[0]
+                if self.in_flight + self.size_of(position) <= self.memory_limit:
+                    return self._start(position)
+            else:
+                # 排在一本书前面、还没读的书都要在它占用预算期间读入，预算还得容得下其中最大的一本
+                ahead = {}
+                largest = 0
+                for position in sorted(self.unstarted):
+                    ahead[position] = largest
+                    largest = max(largest, self.size_of(position))
+                # 从大到小取第一本放得进预算的书
+                for position in self.unstarted:
+                    if self.in_flight + self.size_of(position) + ahead[position] <= self.memory_limit:
+                        return self._start(position)
+        # 排在所有已占用预算的书之前的书：处理它之前不会有书释放预算，超过限制也要读取
+        first = min(self.unstarted)
+        if not self.reserved or first < min(self.reserved):
+            return self._start(first)
+        return None
+    
+    def _start(self, position: int) -> int:
+        self.unstarted.remove(position)
+        self.reserved[position] = self.size_of(position)
+        self.in_flight += self.reserved[position]
+        return position
+    
+    def _resize(self, position: int, size: int):
+        """读取中央目录后，把占用的预算改为实际要读入内存的大小"""
+        with self.condition:
+            self.in_flight += size - self.reserved[position]
+            self.reserved[position] = size
+            self.condition.notify_all()
+    
+    def release(self, book: BookData):
+        """一本书处理完后归还其占用的内存预算"""
+        with self.condition:
+            # 不启动线程时不占用预算
+            self.in_flight -= self.reserved.pop(book.index - self.first_index, 0)
+            self.condition.notify_all()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                position = None
+                while not self.stopped and self.unstarted:
+                    position = self._next()
+                    if position is not None:
+                        break
+                    self.condition.wait()
+                if position is None:
+                    return
+            try:
+                item = self.merger.load_book(self.first_index + position, self.epub_files[position],
+                                             lambda size, position=position: self._resize(position, size))
+            except Exception as e:
+                # 异常交给消费者在对应位置重新抛出
+                item = e
+            with self.condition:
+                self.ready[position] = item
+                self.condition.notify_all()
+    
+    def __iter__(self):
+        if not self.threads:
+            for index, epub_file in enumerate(self.epub_files, self.first_index):
+                name = epub_file if isinstance(epub_file, (str, os.PathLike)) else f'book_{index+1}.epub'
+                yield self.merger.run_phase('读取', name, self.merger.load_book, index, epub_file)
+            return
+        for position in range(len(self.epub_files)):
+            with self.condition:
+                while position not in self.ready:
+                    self.condition.wait()
+                item = self.ready.pop(position)
+                self.condition.notify_all()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def close(self):
+        """停止预读线程"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+class MergeCache:
+    """可在多次合并之间共享的缓存（线程安全）
+    
+    packages按(路径, 修改时间, 大小)缓存已解析的书包结构；
+    compressed按(内容哈希, 压缩级别)缓存压缩好的成员，相同的资源不再重复压缩。
+    两者都按最近最少使用淘汰。
+    """
+    
+    def __init__(self, max_packages: int = 1024, max_compressed_bytes: int = 256 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_packages = max_packages
+        self.max_compressed_bytes = max_compressed_bytes
+        self.packages = OrderedDict()
+        self.compressed = OrderedDict()
+        self.compressed_bytes = 0
+        self.stats = {'package_hits': 0, 'package_misses': 0, 'compressed_hits': 0, 'compressed_misses': 0}
+    
+    @staticmethod
+    def file_key(path: str) -> Tuple:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+    
+    def get_package(self, key: Tuple):
+        with self.lock:
+            package = self.packages.get(key)
+            if package is None:
+                self.stats['package_misses'] += 1
+                return None
+            self.packages.move_to_end(key)
+            self.stats['package_hits'] += 1
+        opf_name, spine, manifest, metadata = package
+        # 元数据在合并过程中会被补充，每次返回一份副本
+        return opf_name, spine, manifest, dict(metadata)
+    
+    def put_package(self, key: Tuple, package: Tuple):
+        opf_name, spine, manifest, metadata = package
+        with self.lock:
+            self.packages[key] = (opf_name, spine, manifest, dict(metadata))
+            self.packages.move_to_end(key)
+            while len(self.packages) > self.max_packages:
+                self.packages.popitem(last=False)
+    
+    def get_compressed(self, key: Tuple):
+        with self.lock:
+            entry = self.compressed.get(key)
+            if entry is None:
+                self.stats['compressed_misses'] += 1
+                return None
+            self.compressed.move_to_end(key)
+            self.stats['compressed_hits'] += 1
+            return entry
+    
+    def put_compressed(self, key: Tuple, entry: Tuple):
+        size = len(entry[0])
+        if size > self.max_compressed_bytes:
+            return
+        with self.lock:
+            if key in self.compressed:
+                return
+            self.compressed[key] = entry
+            self.compressed_bytes += size
+            while self.compressed_bytes > self.max_compressed_bytes:
+                _, (raw, _, _) = self.compressed.popitem(last=False)
+                self.compressed_bytes -= len(raw)
+    
+    def snapshot(self) -> Dict:
+        """返回缓存的统计信息"""
+        with self.lock:
+            return dict(self.stats, packages=len(self.packages), compressed_entries=len(self.compressed),
+                        compressed_bytes=self.compressed_bytes)
+
+
+class ZipStreamWriter:
+    """最小的ZIP写出器：直接写入已压缩好的成员数据，不需要seek，超出限制时自动使用ZIP64"""
+    
+    def __init__(self, fileobj, date_time: Tuple[int, ...] = None):
+        self.fp = fileobj
+        self.offset = 0
+        self.entries = []
+        year, month, day, hour, minute, second = (date_time or time.localtime())[:6]
+        self.dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        self.dos_time = hour << 11 | minute << 5 | second // 2
+    
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+    
+    def write_raw(self, arcname: str, raw, crc: int, file_size: int, compress_type: int):
+        """写入一个成员，raw为按compress_type压缩好的数据"""
+        name = arcname.encode('utf-8')
+        compress_size = len(raw)
+        zip64 = file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b''
+            sizes = (compress_size, file_size)
+        version = 45 if zip64 else 20
+        header = struct.pack('<4s5H3L2H', b'PK\x03\x04', version, 0x800, compress_type,
+                             self.dos_time, self.dos_date, crc, sizes[0], sizes[1], len(name), len(extra))
+        self.entries.append((name, compress_type, crc, compress_size, file_size, self.offset))
+        self._write(header + name + extra)
+        self._write(raw)
+    
+    def close(self):
+        """写入中央目录和结束记录"""
+        central_offset = self.offset
+        for name, compress_type, crc, compress_size, file_size, offset in self.entries:
+            zip64_fields = []
+            if file_size >= ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+            if compress_size >= ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            header = struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 3 << 8 | version, version, 0x800, compress_type,
+                                 self.dos_time, self.dos_date, crc,
+                                 min(compress_size, 0xFFFFFFFF), min(file_size, 0xFFFFFFFF),
+                                 len(name), len(extra), 0, 0, 0, 0o644 << 16, min(offset, 0xFFFFFFFF))
+            self._write(header + name + extra)
+        
+        central_size = self.offset - central_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or central_size >= ZIP64_LIMIT or central_offset >= ZIP64_LIMIT:
+            zip64_end_offset = self.offset
+            self._write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                                    count, count, central_size, central_offset))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end_offset, 1))
+        self._write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                min(central_size, 0xFFFFFFFF), min(central_offset, 0xFFFFFFFF), 0))
+        self.fp.flush()
+
+
+class EpubWriter:
+    """写出合并后的EPUB：成员在线程池中并行压缩（zlib压缩时释放GIL），
+    写出线程按提交顺序把压缩好的数据追加到压缩包中，与输入书的处理重叠进行
+    
+    output_path也可以是可写的二进制流（如HTTP响应体），只顺序写入、不需要seek，也不会被关闭。
+    inline为True时在调用add的线程中压缩（记录性能时使用，压缩耗时计入提交成员的阶段）。
+    """
+    
+    def __init__(self, output_path, queue_depth: int = 64, compression_level: int = -1,
+                 workers: int = None, cache: MergeCache = None, date_time: Tuple[int, ...] = None,
+                 inline: bool = False):
+        self.output_path = output_path
+        self.compression_level = compression_level
+        self.cache = cache
+        self.inline = inline
+        self.owned = isinstance(output_path, (str, os.PathLike))
+        self.fp = open(output_path, 'wb') if self.owned else output_path
+        self.zip_writer = ZipStreamWriter(self.fp, date_time)
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                       thread_name_prefix='epub-deflate')
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='epub-writer', daemon=True)
+        self.thread.start()
+    
+    def compress(self, data: bytes, compress: bool) -> Tuple[bytes, int, int]:
+        """压缩一个成员，返回(压缩后数据, CRC, 压缩方式)；压缩后没有变小的成员直接存储"""
+        if not compress:
+            return data, zlib.crc32(data), ZIP_STORED
+        
+        key = None
+        if self.cache is not None:
+            import hashlib
+            key = (hashlib.sha1(data).digest(), len(data), self.compression_level)
+            entry = self.cache.get_compressed(key)
+            if entry is not None:
+                return entry
+        
+        crc = zlib.crc32(data)
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        raw = compressor.compress(data) + compressor.flush()
+        entry = (raw, crc, ZIP_DEFLATED) if len(raw) < len(data) else (data, crc, ZIP_STORED)
+        if key is not None:
+            self.cache.put_compressed(key, entry)
+        return entry
+    
+    def add(self, arcname: str, data, compress: bool = True):
+        """提交一个成员，data为bytes、memoryview或str；RawMember直接写入其压缩数据
+        
+        返回得到(压缩后数据, CRC, 压缩方式)的Future。
+        """
+        if self.error is not None:
+            raise self.error
+        if isinstance(data, RawMember):
+            from concurrent.futures import Future
+            future = Future()
+            future.set_result((data.raw, data.crc, data.compress_type))
+            self.queue.put((arcname, data.file_size, future))
+            return future
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.inline:
+            from concurrent.futures import Future
+            future = Future()
+            future.set_result(self.compress(data, compress))
+        else:
+            future = self.pool.submit(self.compress, data, compress)
+        self.queue.put((arcname, len(data), future))
+        return future
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            arcname, file_size, future = item
+            try:
+                raw, crc, compress_type = future.result()
+                self.zip_writer.write_raw(arcname, raw, crc, file_size, compress_type)
+            except Exception as e:
+                self.error = e
+    
+    def close(self):
+        """等待所有成员写完并关闭文件"""
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+        try:
+            if self.error is None:
+                self.zip_writer.close()
+        finally:
+            if self.owned:
+                self.fp.close()
+        if self.error is not None:
+            raise self.error
+    
+    def abort(self):
+        """出错时停止写入并删除不完整的输出文件"""
+        self.error = self.error or RuntimeError('写入已中止')
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+        if self.owned:
+            self.fp.close()
+            if os.path.exists(self.output_path):
+                os.remove(self.output_path)
+
+
+class FolderWatcher:
+    """轮询目录中的EPUB文件，文件增删或修改后等待一段时间不再变化（去抖）再报告
+    
+    只比较文件的修改时间和大小，不读取内容；exclude中的路径和完整匹配exclude_patterns的路径
+    （如输出文件和它的分卷、临时文件）不参与比较。
+    """
+    
+    def __init__(self, directory: str, interval: float = 1.0, debounce: float = 2.0, exclude: set = None,
+                 exclude_patterns: List['re.Pattern'] = None):
+        self.directory = directory
+        self.interval = interval
+        self.debounce = debounce
+        self.exclude = exclude if exclude is not None else set()
+        self.exclude_patterns = list(exclude_patterns or [])
+    
+    @staticmethod
+    def output_pattern(output_path: str) -> 're.Pattern':
+        """匹配输出文件、它的分卷（name_1.epub……）和对应临时文件（name.partial.epub、name.partial_1.epub……）的绝对路径"""
+        name, ext = os.path.splitext(os.path.abspath(output_path))
+        return re.compile(re.escape(name) + r'(?:\.partial)?(?:_\d+)?' + re.escape(ext or '.epub'))
+    
+    @staticmethod
+    def natural_key(path: str):
+        """按文件名自然排序（vol2在vol10之前）"""
+        return [int(part) if part.isdigit() else part.lower()
+                for part in re.split(r'(\d+)', os.path.basename(path))]
+    
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.lower().endswith('.epub'):
+                continue
+            path = os.path.abspath(entry.path)
+            if path in self.exclude or any(pattern.fullmatch(path) for pattern in self.exclude_patterns):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # 扫描期间被删除或无法访问的文件跳过，下一次扫描时再比较
+                continue
+            state[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+    
+    def changes(self):
+        """生成器：启动时和每次目录内容变化并稳定下来后，产出按自然顺序排序的EPUB文件列表"""
+        reported = None
+        current = self.scan()
+        changed_at = time.monotonic() - self.debounce
+        while True:
+            if current != reported and time.monotonic() - changed_at >= self.debounce:
+                reported = current
+                yield sorted(current, key=self.natural_key)
+                # 合并期间exclude可能变化，重新扫描后再比较
+                current = reported = self.scan()
+            time.sleep(self.interval)
+            state = self.scan()
+            if state != current:
+                current = state
+                changed_at = time.monotonic()
+
+
+class MergeProfiler:
+    """记录一次合并的性能：cProfile记录耗时，tracemalloc记录内存分配，都按阶段和书归类
+    
+    每个阶段（读取、处理某本书，写出某卷等）在一个以“阶段: 书名”命名的调用帧中执行，
+    cProfile的结果中各阶段是单独的节点，可以直接用snakeviz等工具按阶段和书查看；
+    记录内存时比较每个阶段前后的快照，记下新增内存最多的分配位置和阶段中的内存峰值，
+    trace_memory为路径时结束后把各阶段的记录以JSON写入该文件。
+    """
+    
+    def __init__(self, profile_path: str = None, trace_memory=False, top: int = 5):
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.top = top
+        self.profiler = None
+        # 每个阶段的记录：阶段、书、耗时，记录内存时还有新增内存、峰值和分配最多的位置
+        self.phases = []
+        # 阶段名 -> 以该名字命名的调用帧
+        self.frames = {}
+        # 上一个阶段结束时各分配位置占用的内存
+        self.last_sizes = {}
+        # 本类代码所在的行：这些行上的分配是记录本身的开销，不计入统计
+        self.own_lines = self.source_lines()
+    
+    def start(self):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+    
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+            if not isinstance(self.trace_memory, bool):
+                self.dump_memory(self.trace_memory)
+    
+    def dump_memory(self, path: str):
+        """把各阶段的耗时和内存记录写成JSON"""
+        import json
+        phases = [dict(record, top_allocations=[{'site': site, 'size': size}
+                                                for site, size in record.get('top_allocations', [])])
+                  for record in self.phases]
+        with open(path, 'w', encoding='utf-8') as output:
+            json.dump({'phases': phases}, output, ensure_ascii=False, indent=2)
+    
+    @classmethod
+    def source_lines(cls) -> range:
+        """本类在源文件中所占的行，取不到源码时为空"""
+        import inspect
+        try:
+            lines, first = inspect.getsourcelines(cls)
+        except (OSError, TypeError):
+            return range(0)
+        return range(first, first + len(lines))
+    
+    def frame(self, name: str) -> Callable:
+        """返回以name命名的函数frame(func, args)，cProfile按它的名字记录阶段"""
+        frame = self.frames.get(name)
+        if frame is None:
+            def frame(func, args):
+                return func(*args)
+            code = frame.__code__
+            if hasattr(code, 'replace'):
+                changes = {'co_name': name}
+                if hasattr(code, 'co_qualname'):
+                    changes['co_qualname'] = name
+                frame.__code__ = code.replace(**changes)
+            self.frames[name] = frame
+        return frame
+    
+    def run(self, phase: str, name: str, func: Callable, *args):
+        """在名为“阶段: 名字”的调用帧中执行func，记录耗时和内存"""
+        record = {'phase': phase, 'name': name}
+        if self.trace_memory:
+            import tracemalloc
+            start_memory = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            return self.frame(f'{phase}: {name}')(func, args)
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if self.trace_memory:
+                # 统计内存时暂停cProfile，快照本身的开销不计入记录
+                if self.profiler is not None:
+                    self.profiler.disable()
+                current, peak = tracemalloc.get_traced_memory()
+                record['allocated'] = current - start_memory
+                record['peak'] = peak
+                record['top_allocations'] = self.allocation_growth()
+                if self.profiler is not None:
+                    self.profiler.enable()
+            self.phases.append(record)
+    
+    def allocation_growth(self) -> List[Tuple[str, int]]:
+        """与上一个阶段结束时相比，按代码行统计新增内存最多的分配位置：(位置, 新增字节数)"""
+        import tracemalloc
+        own_file = MergeProfiler.run.__code__.co_filename
+        sizes = {}
+        for stat in tracemalloc.take_snapshot().statistics('lineno'):
+            frame = stat.traceback[0]
+            if frame.filename == tracemalloc.__file__:
+                continue
+            if frame.filename == own_file and frame.lineno in self.own_lines:
+                continue
+            sizes[str(frame)] = stat.size
+        growth = sorted(((site, size - self.last_sizes.get(site, 0)) for site, size in sizes.items()),
+                        key=lambda item: item[1], reverse=True)
+        self.last_sizes = sizes
+        return [(site, size) for site, size in growth[:self.top] if size > 0]
+    
+    def hotspots(self, count: int = 10) -> List[Tuple[str, int, float, float]]:
+        """返回自身耗时最多的函数：(函数, 调用次数, 自身耗时, 累计耗时)"""
+        if self.profiler is None:
+            return []
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        return [(pstats.func_std_string(func), calls, tottime, cumtime)
+                for func, (_, calls, tottime, cumtime, _) in rows]
+
+
 class EpubMerger:
-    def __init__(self, language='zh-CN'):
-        self.namespace = {'ns': 'http://www.idpf.org/2007/opf'}
+    DEFAULT_METADATA_RULES = {'title': 'series', 'creators': 'union', 'cover': 'first'}
+    
+    def __init__(self, language='zh-CN', prune=False, metadata_rules=None, title=None, creators=None,
+                 prefetch_depth=2, prefetch_memory=256 * 1024 * 1024, write_queue_depth=64,
+                 compression_level=-1, compress_workers=None, cache=None, max_output_size=None,
+                 split_every=None, consolidate_size=None, deterministic=False, dedupe_css=False,
+                 subset_fonts=False, incremental=False, profile_path=None, trace_memory=False,
+                 read_workers=1, keep_layout=False):
         self.merged_content = []
         self.merged_resources = {}
         self.resource_counter = 1
         # 添加资源路径映射
-        self.resource_mapping = {}  # 原始路径 -> 新路径
+        self.resource_mapping = {}  # 原始路径（压缩包内的路径） -> 新路径
         self.id_mapping = {}  # 原始ID -> 新ID
         # 添加语言设置
         self.language = language
         # 添加文件名计数器，避免重名
         self.filename_counter = {}
+        # 是否裁剪未被引用的资源
+        self.prune = prune
+        # 资源引用图：新路径 -> 该资源引用的新路径集合
+        self.reference_graph = {}
+        # 已确定可达的资源
+        self.reachable = set()
+        self.pruned_count = 0
+        self.pruned_bytes = 0
+        # 元数据合并规则：
+        #   title    - series(同一系列时用系列名，否则用第一本书名) / first(第一本书名) / join(依次拼接书名)
+        #   creators - union(按出现顺序去重合并) / first(只用第一本书的作者)
+        #   cover    - first(使用第一个有封面的书的封面) / none(不设置封面)
+        self.metadata_rules = dict(self.DEFAULT_METADATA_RULES)
+        if metadata_rules:
+            self.metadata_rules.update(metadata_rules)
+        # 显式指定的标题和作者，优先于合并规则
+        self.title = title
+        self.creators = creators
+        # 每本输入书的元数据
+        self.book_metadata = []
+        # 预读和写出流水线：预读的书数、预读内存上限（字节）、写出队列深度
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_memory = prefetch_memory
+        self.write_queue_depth = write_queue_depth
+        # 同时读取输入书的线程数，多于1时先读大书，结果仍按输入顺序处理
+        self.read_workers = read_workers
+        # 输出压缩级别（-1为zlib默认，0-9）和并行压缩的线程数（默认为CPU核数）
+        self.compression_level = compression_level
+        self.compress_workers = compress_workers
+        # 多次合并之间共享的缓存（MergeCache），为None时不缓存
+        self.cache = cache
+        # 分卷输出：每卷的大小上限（字节，按输入书压缩后的大小估算）和每卷的书数，为None时不分卷
+        self.max_output_size = max_output_size
+        self.split_every = split_every
+        # 当前输出卷的目录：(书名, 第一个spine文档的路径)
+        self.toc = []
+        # 合并小章节：同一本书中连续的小spine文档拼接成不超过该大小（字节）的文档，为None时不合并
+        self.consolidate_size = consolidate_size
+        # 被拼接的章节：章节原本的新路径 -> (拼接后的文档路径, 章节所在节的ID, 章节内ID的重命名表)
+        self.consolidated = {}
+        # 可重现模式：相同的输入和选项得到逐字节相同的输出（固定时间戳，标识符由输入内容派生）
+        self.deterministic = deterministic
+        # 样式表去重：规范化样式表、去掉重复规则，规范化后相同的样式表只输出一份
+        self.dedupe_css = dedupe_css
+        # 已输出的样式表：规范化内容的哈希 -> (输出路径, 所在书的序号)
+        self.shared_stylesheets = {}
+        # 样式表规范化结果的缓存：原内容的哈希 -> 规范化后的内容
+        self.css_cache = {}
+        # 引用解析结果的缓存：(引用所在目录, 引用) -> 压缩包内的路径
+        self.path_cache = {}
+        # 正在处理的书的OPF所在目录，引用按所在文档解析不到时再按它解析
+        self.opf_dir = ''
+        # 字体子集化：把嵌入字体裁剪为只含本卷正文用到的字符（需要fontTools）
+        self.subset_fonts = subset_fonts
+        # 本卷正文用到的字符，以及等所有正文处理完才写出的字体：(输出路径, 数据)
+        self.codepoints = set()
+        self.pending_fonts = []
+        # 子集化结果的缓存：(字体哈希, 字符集哈希) -> 裁剪后的字体
+        self.font_cache = {}
+        self.font_saved_bytes = 0
+        # 增量合并：记录每本书的处理结果，下次合并时输入顺序、文件和选项都未变的前缀直接重放，不再读取
+        self.incremental = incremental
+        # 输入前缀的键 -> ProcessedBook，只保留最近一次合并的结果
+        self.processed_books = {}
+        self.reused_books = 0
+        # 本次合并写出的文件
+        self.output_paths = []
+        # 性能记录：把cProfile结果写到profile_path，trace_memory时用tracemalloc记录各阶段的内存分配，
+        # trace_memory为路径时把内存记录以JSON写入该文件；
+        # 记录时预读和压缩都改在主线程中依次进行，所有耗时都能归到对应的阶段和书
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        # 最近一次合并的MergeProfiler，不记录时为None
+        self.profiler = None
+        # 保留原有目录结构：每本书的成员原样放在book_NNN/下，不改写引用，只重新生成OPF和导航
+        self.keep_layout = keep_layout
+        # 已有的book_NNN目录的最大序号，追加的书接着编号
+        self.layout_offset = 0
         
-    def extract_epub(self, epub_path: str) -> str:
-        """解压EPUB文件到临时目录"""
-        temp_dir = tempfile.mkdtemp()
-        with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        return temp_dir
-    
-    def parse_container_xml(self, temp_dir: str) -> str:
-        """解析container.xml获取content.opf路径"""
-        container_path = os.path.join(temp_dir, 'META-INF', 'container.xml')
-        if not os.path.exists(container_path):
-            raise FileNotFoundError(f"找不到container.xml文件: {container_path}")
+    @staticmethod
+    def parse_xml_stream(source, start_handler, end_handler=None, data_handler=None):
+        """用expat流式解析XML（路径或文件对象），只回调处理函数，不在内存中构建任何树
         
-        tree = ET.parse(container_path)
-        root = tree.getroot()
+        标签名会去掉命名空间前缀（如 opf:item -> item）后传给处理函数。
+        """
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = lambda tag, attrib: start_handler(tag.rpartition(':')[2], attrib)
+        if end_handler:
+            parser.EndElementHandler = lambda tag: end_handler(tag.rpartition(':')[2])
+        if data_handler:
+            parser.CharacterDataHandler = data_handler
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                parser.ParseFile(f)
+        else:
+            parser.ParseFile(source)
+    
+    def parse_container_stream(self, source) -> str:
+        """流式解析container.xml，返回第一个rootfile的full-path（EPUB内的路径）"""
+        rootfiles = []
         
-        # 定义container.xml的命名空间
-        container_ns = {'container': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+        def start(tag, attrib):
+            if tag == 'rootfile' and attrib.get('full-path'):
+                rootfiles.append(attrib['full-path'])
         
-        # 查找rootfile元素，尝试不同的方法
-        rootfiles = root.findall('.//rootfile')
+        self.parse_xml_stream(source, start)
         if not rootfiles:
-            # 尝试带命名空间的方法
-            rootfiles = root.findall('.//container:rootfile', container_ns)
+            raise ValueError("在container.xml中找不到rootfile")
+        return rootfiles[0]
+    
+    def read_package(self, zip_ref: 'zipfile.ZipFile') -> Tuple[str, List[str], Dict[str, str], Dict]:
+        """直接从EPUB压缩包中流式读取container.xml和OPF，返回(OPF路径, spine, manifest, 元数据)"""
+        try:
+            with zip_ref.open('META-INF/container.xml') as container:
+                opf_name = self.parse_container_stream(container)
+        except KeyError:
+            raise FileNotFoundError(f"找不到container.xml文件: {zip_ref.filename}")
+        
+        with zip_ref.open(opf_name) as opf:
+            spine, manifest, metadata = self.parse_content_opf(opf)
+        return opf_name, spine, manifest, metadata
+    
+    def parse_content_opf(self, opf_source) -> Tuple[List[str], Dict[str, str], Dict]:
+        """流式解析content.opf（路径或文件对象），一次遍历获取spine顺序、manifest资源、元数据和guide"""
+        manifest = {}
+        itemrefs = []
+        metadata = {
+            'title': None,
+            'creators': [],
+            'series': None,
+            'series_index': None,
+            'identifier': None,
+            'cover': None,
+            'guide': [],
+            # spine中引用了但manifest里没有的idref
+            'unresolved_spine': []
+        }
+        identifiers = []
+        cover_meta = None
+        unique_identifier = None
+        # 正在收集文本的元数据元素
+        text_tag = None
+        text_id = None
+        text_parts = []
         
-        for rootfile in rootfiles:
-            full_path = rootfile.get('full-path')
-            if full_path:
-                return os.path.join(temp_dir, full_path)
+        def start(tag, attrib):
+            nonlocal cover_meta, unique_identifier, text_tag, text_id
+            if tag == 'item':
+                # manifest中的资源
+                item_id = attrib.get('id')
+                href = attrib.get('href')
+                if item_id and href:
+                    manifest[item_id] = ManifestItem(href, attrib.get('media-type'), attrib.get('properties', ''))
+            elif tag == 'itemref':
+                itemrefs.append(attrib.get('idref'))
+            elif tag in ('title', 'creator', 'identifier'):
+                text_tag = tag
+                text_id = attrib.get('id')
+                text_parts.clear()
+            elif tag == 'meta':
+                name = attrib.get('name')
+                if name == 'cover':
+                    cover_meta = attrib.get('content')
+                elif name == 'calibre:series':
+                    metadata['series'] = attrib.get('content')
+                elif name == 'calibre:series_index':
+                    metadata['series_index'] = attrib.get('content')
+                elif attrib.get('property') == 'belongs-to-collection':
+                    text_tag = 'collection'
+                    text_parts.clear()
+            elif tag == 'reference':
+                # guide中的引用
+                if attrib.get('href'):
+                    metadata['guide'].append({
+                        'type': attrib.get('type'),
+                        'href': attrib['href'],
+                        'title': attrib.get('title')
+                    })
+            elif tag == 'package':
+                unique_identifier = attrib.get('unique-identifier')
         
-        # 如果还是找不到，尝试直接查找
-        for elem in root.iter():
-            if elem.tag.endswith('rootfile') or 'rootfile' in elem.tag:
-                full_path = elem.get('full-path')
-                if full_path:
-                    return os.path.join(temp_dir, full_path)
+        def end(tag):
+            nonlocal text_tag
+            if text_tag is None or (tag != text_tag and not (tag == 'meta' and text_tag == 'collection')):
+                return
+            text = ''.join(text_parts).strip()
+            if text:
+                if text_tag == 'title':
+                    if metadata['title'] is None:
+                        metadata['title'] = text
+                elif text_tag == 'creator':
+                    metadata['creators'].append(text)
+                elif text_tag == 'identifier':
+                    identifiers.append((text_id, text))
+                elif not metadata['series']:
+                    metadata['series'] = text
+            text_tag = None
         
-        raise ValueError("在container.xml中找不到rootfile")
-    
-    def parse_content_opf(self, opf_path: str) -> Tuple[List[str], Dict[str, str]]:
-        """解析content.opf文件，获取spine顺序和manifest资源"""
-        tree = ET.parse(opf_path)
-        root = tree.getroot()
+        def data(text):
+            if text_tag is not None:
+                text_parts.append(text)
         
-        # 获取manifest中的资源
-        manifest = {}
-        for item in root.findall('.//ns:item', self.namespace):
-            item_id = item.get('id')
-            href = item.get('href')
-            media_type = item.get('media-type')
-            if item_id and href:
-                manifest[item_id] = {
-                    'href': href,
-                    'media-type': media_type
-                }
+        self.parse_xml_stream(opf_source, start, end, data)
         
         # 获取spine顺序
-        spine = []
-        for itemref in root.findall('.//ns:itemref', self.namespace):
-            idref = itemref.get('idref')
-            if idref in manifest:
-                spine.append(idref)
-        
-        return spine, manifest
-    
-    def read_file_content(self, base_path: str, file_path: str) -> str:
-        """读取文件内容"""
-        full_path = os.path.join(base_path, file_path)
-        if os.path.exists(full_path):
-            with open(full_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        return ""
-    
-    def copy_resource(self, source_base: str, source_path: str, target_base: str, target_path: str):
-        """复制资源文件"""
-        source_full = os.path.join(source_base, source_path)
-        target_full = os.path.join(target_base, target_path)
-        
-        # 确保目标目录存在
-        os.makedirs(os.path.dirname(target_full), exist_ok=True)
-        
-        if os.path.exists(source_full):
-            shutil.copy2(source_full, target_full)
-            logger.info(f"复制资源: {source_path} -> {target_path}")
-    
-    def normalize_path(self, path: str, base_path: str) -> str:
-        """标准化路径，处理各种相对路径情况"""
-        if not path:
-            return path
-            
-        original_path = path
+        spine = [idref for idref in itemrefs if idref in manifest]
+        metadata['unresolved_spine'] = [idref for idref in itemrefs if idref not in manifest]
+        
+        # 优先使用package声明的唯一标识符
+        for identifier_id, identifier in identifiers:
+            if metadata['identifier'] is None or identifier_id == unique_identifier:
+                metadata['identifier'] = identifier
         
-        # 移除开头的 './'
-        if path.startswith('./'):
-            path = path[2:]
+        # EPUB2的封面声明 <meta name="cover" content="id"/> 统一记为cover-image属性；
+        # 只接受图片，指向XHTML等其他文档的声明忽略（cover-image只能用于图片）
+        if (cover_meta in manifest and manifest[cover_meta].media_type.startswith('image/')
+                and 'cover-image' not in manifest[cover_meta].properties.split()):
+            manifest[cover_meta].properties = (manifest[cover_meta].properties + ' cover-image').strip()
+        for item_id, item_info in manifest.items():
+            if 'cover-image' in item_info.properties.split():
+                metadata['cover'] = item_id
+                break
         
-        # 处理绝对路径（相对于EPUB根目录）
-        if path.startswith('/'):
-            path = path[1:]
+        return spine, manifest, metadata
+    
+    def classify_manifest(self, spine: List[str], manifest: Dict) -> List[str]:
+        """按manifest顺序返回不在spine中的资源ID，spine用集合判断成员，整体为线性时间"""
+        spine_ids = set(spine)
+        return [item_id for item_id in manifest if item_id not in spine_ids]
+    
+    def find_member(self, zip_ref: 'zipfile.ZipFile', opf_dir: str, href: str):
+        """查找manifest中href对应的压缩包成员，找不到时返回None"""
+        import urllib.parse
+        name = posixpath.normpath(posixpath.join(opf_dir, href))
+        for candidate in (name, urllib.parse.unquote(name)):
+            try:
+                return zip_ref.getinfo(candidate)
+            except KeyError:
+                continue
+        return None
+    
+    def load_book(self, index: int, epub_file, reserve: Callable[[int], None] = None) -> BookData:
+        """读取一本输入书：解析OPF，把需要改写的成员解压到内存，其余成员只取原始压缩数据
         
-        # 处理包含 '../' 的路径
-        if '../' in path:
-            # 计算相对路径
-            path_parts = path.split('/')
-            base_parts = base_path.split(os.sep)
+        epub_file为文件路径、bytes或二进制文件对象。
+        """
+        with MappedArchive(epub_file) as archive:
+            zip_ref = archive.zip_ref
+            # 直接从压缩包中读取container.xml和content.opf，文件未变化时使用缓存的解析结果
+            package = None
+            is_path = isinstance(epub_file, (str, os.PathLike))
+            if self.cache is not None and is_path:
+                cache_key = self.cache.file_key(epub_file)
+                package = self.cache.get_package(cache_key)
+            if package is None:
+                package = self.read_package(zip_ref)
+                if self.cache is not None and is_path:
+                    self.cache.put_package(cache_key, package)
+            opf_name, spine, manifest, metadata = package
+            opf_dir = posixpath.dirname(opf_name)
             
-            # 移除路径中的 '..'
-            while path_parts and path_parts[0] == '..':
-                path_parts.pop(0)
-                if base_parts:
-                    base_parts.pop()
+            # spine文档和样式表等需要改写引用，必须解压；图片、字体等原样写出。
+            # 保留原有目录结构时不改写引用，所有成员都原样写出
+            rewritten = set() if self.keep_layout else {manifest[item_id].href for item_id in spine}
+            infos = {}
+            raw_members = {}
+            for item_info in manifest.values():
+                info = self.find_member(zip_ref, opf_dir, item_info.href)
+                if info is None:
+                    continue
+                infos[item_info.href] = info
+                if self.keep_layout or (item_info.href not in rewritten
+                                        and item_info.media_type not in REWRITTEN_MEDIA_TYPES):
+                    member = archive.raw_member(info)
+                    if member is not None:
+                        raw_members[item_info.href] = member
             
-            # 重新组合路径
-            if base_parts:
-                path = os.path.join(*base_parts, *path_parts)
-            else:
-                path = '/'.join(path_parts)
+            # 按中央目录中的大小预留内存预算：解压的成员按解压后大小，原样写出的按压缩后大小
+            size = sum(info.compress_size if href in raw_members else info.file_size
+                       for href, info in infos.items())
+            if reserve:
+                reserve(size)
+            
+            members = {href: raw_members[href] if href in raw_members else archive.read(info)
+                       for href, info in infos.items()}
+        
+        # 由中央目录中的CRC和大小得到本书内容的摘要，可重现模式用它派生输出的标识符
+        import hashlib
+        digest = hashlib.sha1()
+        for href, info in infos.items():
+            digest.update(f'{href}\0{info.CRC}\0{info.file_size}\n'.encode('utf-8'))
+        metadata['digest'] = digest.hexdigest()
+        
+        compressed_size = sum(info.compress_size for info in infos.values())
+        # 不是文件路径的输入用文件对象的name，没有时用序号作为日志和目录中的名字
+        path = epub_file if is_path else getattr(epub_file, 'name', None)
+        if not isinstance(path, (str, os.PathLike)):
+            path = f'book_{index+1}.epub'
+        return BookData(index, os.fspath(path), opf_name, spine, manifest, metadata, members, size, compressed_size)
+    
+    @staticmethod
+    def input_size(epub_file) -> int:
+        """由中央目录得到输入书所有成员解压后的总大小，不解压任何成员；读不出（或是不能seek的文件对象）时返回0"""
+        import io
+        import zipfile
+        if isinstance(epub_file, (bytes, bytearray, memoryview)):
+            epub_file = io.BytesIO(epub_file)
+        position = None
+        if not isinstance(epub_file, (str, os.PathLike)):
+            if not getattr(epub_file, 'seekable', lambda: False)():
+                return 0
+            position = epub_file.tell()
+        try:
+            with zipfile.ZipFile(epub_file) as zip_ref:
+                return sum(info.file_size for info in zip_ref.infolist())
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return 0
+        finally:
+            if position is not None:
+                epub_file.seek(position)
+    
+    def check_epub(self, epub_file: str) -> Dict:
+        """不解压地检查一本输入书：只读中央目录、container.xml和OPF，
+        确认spine和manifest中的成员都存在且能解压（spine文档还要能按UTF-8解码），并估算输出大小
+        """
+        import zipfile
+        report = {'path': epub_file, 'problems': [], 'spine': 0, 'manifest': 0, 'estimated_size': 0}
+        problems = report['problems']
+        try:
+            with zipfile.ZipFile(epub_file, 'r') as zip_ref:
+                try:
+                    opf_name, spine, manifest, metadata = self.read_package(zip_ref)
+                except KeyError as e:
+                    problems.append(f"找不到OPF文件: {e}")
+                    return report
+                except (FileNotFoundError, ValueError, xml.parsers.expat.ExpatError) as e:
+                    problems.append(f"无法解析container.xml或OPF: {e}")
+                    return report
+                
+                report['spine'] = len(spine)
+                report['manifest'] = len(manifest)
+                if not spine:
+                    problems.append("spine为空")
+                for idref in metadata['unresolved_spine']:
+                    problems.append(f"spine引用了manifest中不存在的项: {idref}")
+                
+                opf_dir = posixpath.dirname(opf_name)
+                spine_ids = set(spine)
+                for item_id, item_info in manifest.items():
+                    info = self.find_member(zip_ref, opf_dir, item_info.href)
+                    if info is None:
+                        problems.append(f"manifest中的文件不存在: {item_info.href}")
+                        continue
+                    report['estimated_size'] += info.compress_size
+                    try:
+                        # 读取时会校验CRC
+                        data = zip_ref.read(info)
+                        if item_id in spine_ids and item_info.media_type == 'application/xhtml+xml':
+                            data.decode('utf-8')
+                    except UnicodeDecodeError:
+                        problems.append(f"spine文档不是UTF-8编码: {item_info.href}")
+                    except (zipfile.BadZipFile, zlib.error, NotImplementedError, EOFError, RuntimeError) as e:
+                        # 加密的成员没有密码时zipfile抛出RuntimeError
+                        problems.append(f"无法解压 {item_info.href}: {e}")
+        except (zipfile.BadZipFile, OSError) as e:
+            problems.append(f"不是有效的EPUB/ZIP文件: {e}")
+        return report
+    
+    def check_epubs(self, epub_files: List[str], workers: int = None) -> List[Dict]:
+        """并行检查多本输入书，按输入顺序返回检查结果"""
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            return list(pool.map(self.check_epub, epub_files))
+    
+    def read_text_member(self, book: BookData, href: str) -> str:
+        """读取书中的文本成员"""
+        data = book.members.get(href)
+        if data is None:
+            return ""
+        return str(data, 'utf-8')
+    
+    def rewrite_text_resource(self, book: BookData, href: str, new_href: str, media_type: str) -> bytes:
+        """改写样式表或XHTML资源中的资源引用并记录到引用图"""
+        content = self.read_text_member(book, href)
+        # 引用相对于资源文件自身所在目录
+        resource_base = posixpath.dirname(self.normalize_path(href, posixpath.dirname(book.opf_name)))
+        target_dir = posixpath.dirname(new_href)
+        references = set()
+        if media_type == 'text/css':
+            content = self.update_css_references(content, resource_base, self.resource_mapping,
+                                                 target_dir=target_dir, references=references)
+            if self.dedupe_css:
+                content = self.normalize_stylesheet(content)
+        else:
+            content = self.update_html_references(content, resource_base, self.resource_mapping,
+                                                  target_dir=target_dir, references=references)
+        if self.subset_fonts:
+            self.collect_codepoints(content)
+        self.reference_graph[new_href] = references
+        return content.encode('utf-8')
+    
+    @staticmethod
+    def split_css(text: str, delimiters: Tuple[str, ...]) -> List[str]:
+        """按顶层（不在字符串、圆括号和花括号内）的分隔符切分CSS文本，分隔符留在各段末尾；
+        注释被去掉，字符串以外的空白合并为一个空格
+        """
+        parts = []
+        current = []
+        depth = 0
+        for match in CSS_TOKEN.finditer(text):
+            token = match.group(0)
+            if token.startswith('/*'):
+                continue
+            if token.isspace():
+                token = ' '
+            elif token in ('(', '{'):
+                depth += 1
+            elif token in (')', '}'):
+                depth = max(depth - 1, 0)
+            current.append(token)
+            if depth == 0 and token in delimiters:
+                parts.append(''.join(current))
+                current = []
+        if current:
+            parts.append(''.join(current))
+        return parts
+    
+    @staticmethod
+    def join_selector(tokens: List[str]) -> str:
+        """拼接选择器的词法单元，去掉首尾和逗号两侧的空白；字符串单元原样保留"""
+        kept = []
+        for index, token in enumerate(tokens):
+            if token.isspace():
+                after = tokens[index + 1] if index + 1 < len(tokens) else ''
+                # 字符串单元以引号开头和结尾，不会被当作逗号
+                if not kept or not after or kept[-1].endswith(',') or after.startswith(','):
+                    continue
+            kept.append(token)
+        return ''.join(kept)
+    
+    def normalize_css_statements(self, css: str) -> List[str]:
+        """把样式表规范化为顶层语句列表：去掉注释和多余空白，属性名小写，
+        完全相同的语句只保留最后一个（后出现的相同规则覆盖前面的，去掉前面的不改变层叠结果）；
+        @charset、@import和@namespace只在样式表开头有效，重复时保留第一个
+        """
+        statements = []
+        for statement in self.split_css(css, (';', '}')):
+            statement = statement.strip()
+            if not statement or statement == ';':
+                continue
+            # 按词法单元找第一个花括号，字符串中的花括号和逗号不参与切分
+            tokens = [match.group(0) for match in CSS_TOKEN.finditer(statement[:-1])] if statement.endswith('}') else []
+            if '{' in tokens:
+                brace = tokens.index('{')
+                prelude = self.join_selector(tokens[:brace])
+                body = ''.join(tokens[brace + 1:])
+                if '{' in body:
+                    # @media等嵌套规则
+                    body = ''.join(self.normalize_css_statements(body))
+                else:
+                    declarations = []
+                    for declaration in self.split_css(body, (';',)):
+                        name, colon, value = declaration.strip().rstrip(';').partition(':')
+                        name = name.strip()
+                        if not colon or not name:
+                            continue
+                        # 自定义属性区分大小写
+                        if not name.startswith('--'):
+                            name = name.lower()
+                        declarations.append(f'{name}:{value.strip()}')
+                    body = ';'.join(declarations)
+                statement = f'{prelude}{{{body}}}'
+            statements.append(statement)
+        
+        last = {statement: index for index, statement in enumerate(statements)}
+        kept = []
+        seen = set()
+        for index, statement in enumerate(statements):
+            if statement.lower().startswith(('@charset', '@import', '@namespace')):
+                if statement in seen:
+                    continue
+                seen.add(statement)
+            elif last[statement] != index:
+                continue
+            kept.append(statement)
+        return kept
+    
+    def normalize_stylesheet(self, css: str) -> str:
+        """规范化样式表，结果按内容哈希缓存，各书中相同的样式表只解析一次"""
+        import hashlib
+        key = hashlib.sha1(css.encode('utf-8')).digest()
+        normalized = self.css_cache.get(key)
+        if normalized is None:
+            normalized = '\n'.join(self.normalize_css_statements(css)) + '\n'
+            self.css_cache[key] = normalized
+        return normalized
+    
+    def share_stylesheet(self, data: bytes, new_href: str, book_index: int, referenced: set) -> str:
+        """规范化后内容相同的样式表只输出一份
         
-        # 统一路径分隔符为 '/'
-        path = path.replace('\\', '/')
+        返回之前已输出的相同样式表的路径；没有时登记本样式表并返回None。
+        本书中已有其他样式表@import了本样式表时不共用，避免已改写的引用失效。
+        """
+        import hashlib
+        key = hashlib.sha1(data).digest()
+        shared = self.shared_stylesheets.get(key)
+        if shared is not None and new_href not in referenced:
+            shared_href, shared_book = shared
+            # 之前的书中已被裁剪的样式表不能共用
+            if not self.prune or shared_book == book_index or shared_href in self.reachable:
+                return shared_href
+        self.shared_stylesheets[key] = (new_href, book_index)
+        return None
+    
+    def prune_book_resources(self, book_resources: List[Tuple], resources: Dict, roots: set) -> List[Tuple]:
+        """裁剪本书中spine、导航和封面都无法到达的资源，返回保留下来的资源"""
+        # 沿引用图做广度优先遍历，之前的书已经展开过的资源不再重复遍历
+        pending = [href for href in roots if href not in self.reachable]
+        while pending:
+            href = pending.pop()
+            if href in self.reachable:
+                continue
+            self.reachable.add(href)
+            pending.extend(self.reference_graph.get(href, ()))
+        
+        kept = []
+        for entry in book_resources:
+            new_id, path, new_href, data = entry
+            if new_href in self.reachable:
+                kept.append(entry)
+                continue
+            del resources[new_id]
+            # 后续的书不能再解析到已裁剪的资源
+            if self.resource_mapping.get(path) == new_href:
+                del self.resource_mapping[path]
+            self.pruned_count += 1
+            self.pruned_bytes += len(data) if data is not None else 0
+            logger.info(f"裁剪未引用资源: {new_href}")
+        return kept
+    
+    def normalize_path(self, path: str, base_path: str) -> str:
+        """把引用解析为压缩包内的路径（POSIX风格，相对于压缩包根目录）
+        
+        base_path为引用所在文档在压缩包内的目录，以/开头的引用相对于压缩包根目录；
+        引用先做百分号解码，反斜杠视为/，超出根目录的..被忽略。
+        结果按(目录, 引用)缓存，同一目录中重复出现的引用只解析一次。
+        """
+        key = (base_path, path)
+        normalized = self.path_cache.get(key)
+        if normalized is not None:
+            return normalized
         
-        logger.debug(f"路径标准化: {original_path} -> {path}")
-        return path
+        from urllib.parse import unquote
+        ref = unquote(path).replace('\\', '/')
+        if ref.startswith('/'):
+            normalized = posixpath.normpath(ref.lstrip('/'))
+        else:
+            normalized = posixpath.normpath(posixpath.join(base_path, ref))
+        while normalized.startswith('../'):
+            normalized = normalized[3:]
+        self.path_cache[key] = normalized
+        return normalized
     
     def get_unique_filename(self, original_filename: str) -> str:
         """生成唯一的文件名，避免重名冲突"""
@@ -169,298 +1507,1331 @@ class EpubMerger:
             self.filename_counter[original_filename] += 1
             return f"{name}_{self.filename_counter[original_filename]}{ext}"
     
-    def update_html_references(self, html_content: str, base_path: str, resource_mapping: Dict) -> str:
-        """更新HTML文件中的资源引用"""
+    def resolve_reference(self, ref: str, base_path: str, resource_mapping: Dict) -> Tuple[str, bool]:
+        """解析资源引用，返回(新路径, 是否通过路径变体匹配)，找不到时新路径为None
+        
+        引用按所在文档的目录解析；找不到时再按OPF所在目录解析引用本身和它的文件名，
+        兼容把路径写成相对OPF目录的书。
+        """
+        new_path = resource_mapping.get(self.normalize_path(ref, base_path))
+        if new_path is not None:
+            return new_path, False
+        
+        for variant in (ref, posixpath.basename(ref)):
+            new_path = resource_mapping.get(self.normalize_path(variant, self.opf_dir))
+            if new_path is not None:
+                return new_path, True
+        return None, False
+    
+    def update_html_references(self, html_content: str, base_path: str, resource_mapping: Dict,
+                               target_dir: str = '', references: set = None) -> str:
+        """更新HTML文件中的资源引用
+        
+        target_dir为文件在输出EPUB中所在的目录，新路径会改写为相对该目录的路径；
+        传入references时，会把解析到的资源新路径记录进去，用于构建引用图。
+        属性值先解码字符实体再解析，写回时重新转义并保留原来的引号；
+        引用中的查询串和锚点原样保留，外部链接（带协议或以//开头）不改写。
+        """
         if not html_content:
             return html_content
+        from html import escape, unescape
+        
+        def relative_to_target(new_path):
+            # 记录引用关系
+            if references is not None:
+                references.add(new_path)
+            if target_dir:
+                new_path = posixpath.relpath(new_path, target_dir)
+            return self.url_path(new_path)
+        
+        # 更新src和href属性（图片、样式表、章节之间的链接等）
+        def update_attribute(match):
+            name, equals, double_quoted, single_quoted = match.groups()
+            if double_quoted is not None:
+                quote, ref = '"', unescape(double_quoted)
+            else:
+                quote, ref = "'", unescape(single_quoted)
+            if not ref or ref.startswith('#') or EXTERNAL_REFERENCE.match(ref):
+                return match.group(0)
             
-        # 更新img标签的src属性
-        def update_img_src(match):
-            src = match.group(1)
-            if src and not src.startswith(('http://', 'https://', 'data:')):
-                # 处理相对路径
-                if src.startswith('#'):
-                    return match.group(0)  # 锚点链接，保持不变
-                
-                # 解析相对路径
-                try:
-                    # 标准化路径
-                    normalized_path = self.normalize_path(src, base_path)
-                    
-                    # 查找对应的新路径
-                    if normalized_path in resource_mapping:
-                        new_path = resource_mapping[normalized_path]
-                        logger.info(f"更新图片引用: {src} -> {new_path}")
-                        return f'src="{new_path}"'
-                    else:
-                        # 尝试其他可能的路径变体
-                        possible_paths = [
-                            normalized_path,
-                            src,
-                            src.lstrip('./'),
-                            src.lstrip('/'),
-                            os.path.basename(src)
-                        ]
-                        
-                        for test_path in possible_paths:
-                            if test_path in resource_mapping:
-                                new_path = resource_mapping[test_path]
-                                logger.info(f"更新图片引用(变体): {src} -> {new_path}")
-                                return f'src="{new_path}"'
-                        
-                        logger.warning(f"未找到资源映射: {normalized_path} (原始: {src})")
-                        logger.debug(f"可用的资源映射键: {list(resource_mapping.keys())[:10]}...")
-                except Exception as e:
-                    logger.warning(f"更新图片引用失败: {src}, 错误: {e}")
+            path, query, fragment = self.split_reference(ref)
+            try:
+                new_path, via_variant = self.resolve_reference(path, base_path, resource_mapping)
+            except Exception as e:
+                logger.warning(f"更新引用失败: {ref}, 错误: {e}")
+                return match.group(0)
+            if not new_path:
+                if name.lower() == 'src':
+                    logger.warning(f"未找到资源映射: {self.normalize_path(path, base_path)} (原始: {ref})")
+                return match.group(0)
             
-            return match.group(0)
-        
-        # 使用正则表达式更新img标签
-        html_content = re.sub(r'src=["\']([^"\']*)["\']', update_img_src, html_content, flags=re.IGNORECASE)
-        
-        # 更新CSS中的背景图片引用
-        def update_css_background(match):
-            url = match.group(1)
-            if url and not url.startswith(('http://', 'https://', 'data:')):
-                # 移除url()包装
-                clean_url = url.strip('"\'')
-                if clean_url.startswith('#'):
-                    return match.group(0)  # 锚点链接，保持不变
-                
+            if new_path in self.consolidated:
+                # 章节已拼接到其他文档中：指向对应的节，锚点按重命名表改写
+                new_path, section_id, id_map = self.consolidated[new_path]
+                fragment = '#' + (id_map.get(fragment[1:], fragment[1:]) if fragment else section_id)
+            new_ref = relative_to_target(new_path) + query + fragment
+            logger.info(f"更新引用{'(变体)' if via_variant else ''}: {ref} -> {new_ref}")
+            return f'{name}{equals}{quote}{escape(new_ref)}{quote}'
+        
+        html_content = HTML_REFERENCE.sub(update_attribute, html_content)
+        
+        # 更新内联样式和<style>中url()引用的资源（如背景图片），保留原来的引号
+        def update_css_url(match):
+            quote, url = self.css_url_parts(match)
+            url = unescape(url)
+            if not url or url.startswith('#') or EXTERNAL_REFERENCE.match(url):
+                return match.group(0)
+            
+            path, query, fragment = self.split_reference(url)
+            try:
+                new_path, via_variant = self.resolve_reference(path, base_path, resource_mapping)
+            except Exception as e:
+                logger.warning(f"更新CSS背景图片失败: {url}, 错误: {e}")
+                return match.group(0)
+            if not new_path:
+                logger.warning(f"未找到CSS资源映射: {self.normalize_path(path, base_path)} (原始: {url})")
+                return match.group(0)
+            
+            new_url = relative_to_target(new_path) + query + fragment
+            logger.info(f"更新CSS背景图片{'(变体)' if via_variant else ''}: {url} -> {new_url}")
+            return f'url({quote}{escape(new_url)}{quote})'
+        
+        return CSS_URL.sub(update_css_url, html_content)
+    
+    def update_css_references(self, css_content: str, base_path: str, resource_mapping: Dict,
+                              target_dir: str = '', references: set = None) -> str:
+        """更新CSS文件中url()引用的资源路径，查询串和锚点原样保留"""
+        if not css_content:
+            return css_content
+        
+        def update_url(match):
+            _, url = self.css_url_parts(match)
+            if not url or url.startswith('#') or EXTERNAL_REFERENCE.match(url):
+                return match.group(0)
+            
+            path, query, fragment = self.split_reference(url)
+            try:
+                new_path, _ = self.resolve_reference(path, base_path, resource_mapping)
+            except Exception as e:
+                logger.warning(f"更新样式表引用失败: {url}, 错误: {e}")
+                return match.group(0)
+            if not new_path:
+                logger.warning(f"未找到样式表资源映射: {url}")
+                return match.group(0)
+            
+            if references is not None:
+                references.add(new_path)
+            if target_dir:
+                new_path = posixpath.relpath(new_path, target_dir)
+            new_url = self.url_path(new_path) + query + fragment
+            logger.info(f"更新样式表引用: {url} -> {new_url}")
+            # 引号内的双引号和反斜杠需要转义
+            return 'url("{}")'.format(new_url.replace('\\', '\\\\').replace('"', '\\"'))
+        
+        return CSS_URL.sub(update_url, css_content)
+    
+    @staticmethod
+    def split_reference(ref: str) -> Tuple[str, str, str]:
+        """把引用拆分为(路径, 查询串, 锚点)，查询串和锚点包含开头的?和#"""
+        if '#' not in ref and '?' not in ref:
+            return ref, '', ''
+        ref, hash_mark, fragment = ref.partition('#')
+        path, question_mark, query = ref.partition('?')
+        return path, question_mark + query, hash_mark + fragment
+    
+    @staticmethod
+    def url_path(path: str) -> str:
+        """把压缩包内的成员路径转为写进OPF、导航和文档引用的URL路径：非ASCII字符、空格、%、?、#等按百分号编码"""
+        from urllib.parse import quote
+        return quote(path, safe="/!$&'()*+,;=@")
+    
+    @staticmethod
+    def css_url_parts(match: 're.Match') -> Tuple[str, str]:
+        """返回CSS_URL匹配到的url()的(引号, 地址)"""
+        if match.group(1) is not None:
+            return '"', match.group(1)
+        if match.group(2) is not None:
+            return "'", match.group(2)
+        return '', match.group(3) or ''
+    
+    def merge_epub(self, epub_files: List, output_path) -> List:
+        """合并多个EPUB文件，返回写出的文件列表
+        
+        后台线程预读后续的书，同时另一个后台线程压缩写出已处理好的成员。
+        设置了max_output_size或split_every时，在书与书之间切分为多卷（output_1.epub、output_2.epub……），
+        每卷有自己的OPF和导航，只包含本卷的书引用的资源；输入仍然只读一遍。
+        
+        输入可以是文件路径、bytes或二进制文件对象；output_path也可以是可写的二进制流（不需要seek），
+        成员处理完就依次写入，合并结束前调用者就能开始发送已写出的数据。输出到流时不能分卷。
+        """
+        return self.profiled(self.merge_books, epub_files, output_path)
+    
+    def profiled(self, func: Callable, *args):
+        """设置了profile_path或trace_memory时，在新的MergeProfiler中执行一次合并"""
+        if not (self.profile_path or self.trace_memory):
+            self.profiler = None
+            return func(*args)
+        self.profiler = MergeProfiler(self.profile_path, self.trace_memory)
+        self.profiler.start()
+        try:
+            return func(*args)
+        finally:
+            self.profiler.stop()
+            if self.profile_path:
+                logger.info(f"性能记录已写入: {self.profile_path}")
+            if self.trace_memory and not isinstance(self.trace_memory, bool):
+                logger.info(f"内存记录已写入: {self.trace_memory}")
+    
+    def run_phase(self, phase: str, name, func: Callable, *args):
+        """执行合并的一个阶段，记录性能时按阶段和书（或输出文件）归类，name为路径或输出流"""
+        if self.profiler is None:
+            return func(*args)
+        if isinstance(name, (str, os.PathLike)):
+            name = os.path.basename(name)
+        else:
+            name = str(getattr(name, 'name', '')) or type(name).__name__
+        return self.profiler.run(phase, name, func, *args)
+    
+    def merge_books(self, epub_files: List, output_path) -> List:
+        """merge_epub的实现"""
+        split = bool(self.max_output_size or self.split_every)
+        if split and not isinstance(output_path, (str, os.PathLike)):
+            raise ValueError("分卷输出需要指定输出文件路径")
+        self.check_layout_options()
+        logger.info(f"开始合并 {len(epub_files)} 个EPUB文件")
+        
+        self.pruned_count = 0
+        self.pruned_bytes = 0
+        self.font_saved_bytes = 0
+        self.output_paths = []
+        # 分卷时各卷共用的资源（字体、样式表等）只哈希压缩一次
+        cache = self.cache
+        if split and cache is None:
+            cache = MergeCache()
+        
+        # 增量合并时，与上次合并相同的输入前缀直接重放，预读线程只读取之后的书
+        book_keys = self.book_keys(epub_files) if self.incremental else []
+        reused = 0
+        while reused < len(book_keys) and book_keys[reused] in self.processed_books:
+            reused += 1
+        processed_books = {}
+        # 本次合并新记录的书及其RecordingWriter，写出完成后再取出压缩结果
+        recorded = []
+        
+        prefetcher = BookPrefetcher(self, epub_files[reused:], depth=self.prefetch_depth,
+                                    memory_limit=self.prefetch_memory, first_index=reused,
+                                    threaded=self.profiler is None, workers=self.read_workers)
+        writer = None
+        all_spine_items = []
+        all_resources = {}
+        part_books = 0
+        part_size = 0
+        try:
+            books = [self.processed_books[key] for key in book_keys[:reused]]
+            for index, book in enumerate(itertools.chain(books, prefetcher)):
                 try:
-                    # 标准化路径
-                    normalized_path = self.normalize_path(clean_url, base_path)
-                    
-                    if normalized_path in resource_mapping:
-                        new_path = resource_mapping[normalized_path]
-                        logger.info(f"更新CSS背景图片: {clean_url} -> {new_path}")
-                        return f'url("{new_path}")'
+                    if writer is None or self.needs_new_part(part_books, part_size, book):
+                        if writer is not None:
+                            self.run_phase('写出', writer.output_path, self.finish_part,
+                                           writer, all_spine_items, all_resources, split)
+                        part_path = self.part_path(output_path, len(self.output_paths) + 1) if split else output_path
+                        writer = self.start_part(part_path, cache)
+                        all_spine_items = self.state_container(list)
+                        all_resources = self.state_container(dict)
+                        part_books = 0
+                        part_size = 0
+                    if isinstance(book, ProcessedBook):
+                        logger.info(f"复用第 {index+1} 个文件的处理结果: {book.path}")
+                        for arcname, member in book.members:
+                            writer.add(arcname, member)
+                        self.restore_state(book.state, all_spine_items, all_resources)
+                        processed_books[book_keys[index]] = book
+                    elif self.incremental:
+                        logger.info(f"处理第 {book.index+1} 个文件: {book.path}")
+                        recorder = RecordingWriter(writer)
+                        self.run_phase('处理', book.path, self.process_book,
+                                       book, recorder, all_spine_items, all_resources)
+                        processed = ProcessedBook(book.path, book.compressed_size, [],
+                                                  self.snapshot_state(all_spine_items, all_resources))
+                        processed_books[book_keys[index]] = processed
+                        recorded.append((processed, recorder))
                     else:
-                        # 尝试其他可能的路径变体
-                        possible_paths = [
-                            normalized_path,
-                            clean_url,
-                            clean_url.lstrip('./'),
-                            clean_url.lstrip('/'),
-                            os.path.basename(clean_url)
-                        ]
-                        
-                        for test_path in possible_paths:
-                            if test_path in resource_mapping:
-                                new_path = resource_mapping[test_path]
-                                logger.info(f"更新CSS背景图片(变体): {clean_url} -> {new_path}")
-                                return f'url("{new_path}")'
-                        
-                        logger.warning(f"未找到CSS资源映射: {normalized_path} (原始: {clean_url})")
-                except Exception as e:
-                    logger.warning(f"更新CSS背景图片失败: {clean_url}, 错误: {e}")
+                        logger.info(f"处理第 {book.index+1} 个文件: {book.path}")
+                        self.run_phase('处理', book.path, self.process_book,
+                                       book, writer, all_spine_items, all_resources)
+                    part_books += 1
+                    part_size += book.compressed_size
+                finally:
+                    if isinstance(book, BookData):
+                        prefetcher.release(book)
+            
+            if writer is None:
+                writer = self.start_part(output_path, cache)
+            self.run_phase('写出', writer.output_path, self.finish_part,
+                           writer, all_spine_items, all_resources, split)
+            writer = None
             
-            return match.group(0)
+            if self.prune:
+                logger.info(f"共裁剪 {self.pruned_count} 个未引用资源，节省 {self.pruned_bytes} 字节")
+            
+            prefetcher.close()
+            if self.incremental:
+                for processed, recorder in recorded:
+                    processed.members = recorder.raw_members()
+                self.processed_books = processed_books
+                self.reused_books = reused
+        except BaseException:
+            prefetcher.close()
+            if writer is not None:
+                writer.abort()
+            # 已经写完的卷也一并删除，失败的合并不留下部分结果
+            for path in self.output_paths:
+                if isinstance(path, (str, os.PathLike)) and os.path.exists(path):
+                    os.remove(path)
+            raise
         
-        # 更新CSS中的url()引用
-        html_content = re.sub(r'url\(["\']?([^"\')\s]*)["\']?\)', update_css_background, html_content, flags=re.IGNORECASE)
+        logger.info(f"合并完成，输出文件: {', '.join(map(str, self.output_paths))}")
+        return self.output_paths
+    
+    def check_layout_options(self):
+        """保留原有目录结构时不改写书的内容，与需要改写内容的选项不能同时使用"""
+        if self.keep_layout and (self.prune or self.consolidate_size or self.dedupe_css or self.subset_fonts):
+            raise ValueError("保留原有目录结构时不支持裁剪资源、拼接章节、样式表去重和字体子集化")
+    
+    def merge_to_bytes(self, epub_files: List) -> bytes:
+        """合并到内存并返回输出EPUB的内容，输入可以是文件路径、bytes或二进制文件对象"""
+        import io
+        output = io.BytesIO()
+        self.merge_epub(epub_files, output)
+        return output.getvalue()
+    
+    def append_epub(self, existing_path: str, epub_files: List[str], output_path: str = None) -> List[str]:
+        """把新的书追加到已合并的EPUB末尾，返回写出的文件列表
         
-        return html_content
+        已有的成员按原始压缩数据直接复制，不解压也不重新压缩；资源ID和文件名的编号接着已有的继续，
+        只处理新书的内容并重新生成导航和content.opf，耗时只与新书的大小有关。
+        output_path为None或与existing_path相同时，先写到临时文件，成功后替换原文件。
+        """
+        return self.profiled(self.append_books, existing_path, epub_files, output_path)
     
-    def merge_epub(self, epub_files: List[str], output_path: str):
-        """合并多个EPUB文件"""
-        logger.info(f"开始合并 {len(epub_files)} 个EPUB文件")
+    def append_books(self, existing_path: str, epub_files: List[str], output_path: str = None) -> List[str]:
+        """append_epub的实现"""
+        if self.max_output_size or self.split_every:
+            raise ValueError("追加模式不支持分卷输出")
+        self.check_layout_options()
+        output_path = output_path or existing_path
+        if os.path.abspath(output_path) == os.path.abspath(existing_path):
+            name, ext = os.path.splitext(output_path)
+            temp_path = f"{name}.partial{ext or '.epub'}"
+        else:
+            temp_path = output_path
+        logger.info(f"追加 {len(epub_files)} 个EPUB文件到 {existing_path}")
         
-        # 创建临时目录用于合并
-        merged_temp_dir = tempfile.mkdtemp()
+        self.pruned_count = 0
+        self.pruned_bytes = 0
+        self.font_saved_bytes = 0
+        self.output_paths = []
         
+        writer = None
+        prefetcher = None
+        all_spine_items = []
+        all_resources = {}
         try:
-            # 创建META-INF目录
-            meta_inf_dir = os.path.join(merged_temp_dir, 'META-INF')
-            os.makedirs(meta_inf_dir, exist_ok=True)
+            with MappedArchive(existing_path) as archive:
+                writer = self.start_part(temp_path, self.cache)
+                self.run_phase('复制', existing_path, self.load_existing,
+                               archive, writer, all_spine_items, all_resources)
+            
+            prefetcher = BookPrefetcher(self, epub_files, depth=self.prefetch_depth,
+                                        memory_limit=self.prefetch_memory, threaded=self.profiler is None,
+                                        workers=self.read_workers)
+            for book in prefetcher:
+                try:
+                    logger.info(f"追加第 {book.index+1} 个文件: {book.path}")
+                    self.run_phase('处理', book.path, self.process_book,
+                                   book, writer, all_spine_items, all_resources)
+                finally:
+                    prefetcher.release(book)
+            prefetcher.close()
+            
+            self.run_phase('写出', writer.output_path, self.finish_part,
+                           writer, all_spine_items, all_resources)
+            writer = None
+            if temp_path != output_path:
+                os.replace(temp_path, output_path)
+            self.output_paths = [output_path]
+        except BaseException:
+            if prefetcher is not None:
+                prefetcher.close()
+            if writer is not None:
+                writer.abort()
+            raise
+        
+        logger.info(f"追加完成，输出文件: {output_path}")
+        return self.output_paths
+    
+    def load_existing(self, archive: MappedArchive, writer: EpubWriter, spine_items: List[str], resources: Dict):
+        """读入已合并EPUB的OPF和导航，原样复制其成员，并让资源ID、文件名和目录接着已有的继续"""
+        zip_ref = archive.zip_ref
+        opf_name, spine, manifest, metadata = self.read_package(zip_ref)
+        opf_dir = posixpath.dirname(opf_name)
+        
+        # OPF中的路径是相对于OPF所在目录的URL，记录为压缩包内的成员路径，写出新的OPF时再编码
+        nav_href = None
+        numbers = [0]
+        for item_id, item_info in manifest.items():
+            properties = item_info.properties.split()
+            if 'nav' in properties:
+                nav_href = self.normalize_path(item_info.href, opf_dir)
+                continue
+            href = self.normalize_path(item_info.href, opf_dir)
+            properties = ' '.join(p for p in properties if p != 'cover-image')
+            resources[item_id] = OutputItem(href, item_info.media_type, href, properties)
+            # 之前的合并中没有被裁剪掉的资源，之后的书都可以共用
+            self.reachable.add(href)
+            match = re.fullmatch(r'item_(\d+)', item_id)
+            if match:
+                numbers.append(int(match.group(1)))
+        spine_items.extend(spine)
+        
+        # 原样复制除mimetype、container.xml、OPF和导航以外的所有成员
+        skipped = {'mimetype', 'META-INF/container.xml', opf_name, nav_href}
+        for info in zip_ref.infolist():
+            name = info.filename
+            if name in skipped or info.is_dir():
+                continue
+            member = archive.raw_member(info)
+            writer.add(name, member if member is not None else archive.read(info))
             
-            # 创建container.xml
-            container_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+            # 编号接着已有的继续：item_XXXX的最大序号，以及resources/中每个文件名已用到的序号
+            match = re.fullmatch(r'item_(\d+)\.xhtml', name)
+            if match:
+                numbers.append(int(match.group(1)))
+            elif posixpath.dirname(name) == 'resources':
+                filename = posixpath.basename(name)
+                self.filename_counter[filename] = max(self.filename_counter.get(filename, 0), 1)
+                match = re.fullmatch(r'(.+)_(\d+)(\.[^.]*)?', filename)
+                if match:
+                    original = match.group(1) + (match.group(3) or '')
+                    self.filename_counter[original] = max(self.filename_counter.get(original, 0),
+                                                          int(match.group(2)))
+            # 保留目录结构时追加的书接着已有的book_NNN编号
+            match = re.match(r'book_(\d+)/', name)
+            if match:
+                self.layout_offset = max(self.layout_offset, int(match.group(1)))
+            
+            # 之后的书中规范化后相同的样式表共用已有的
+            if self.dedupe_css and name.endswith('.css'):
+                import hashlib
+                self.shared_stylesheets[hashlib.sha1(archive.read(info)).digest()] = (name, -1)
+        self.resource_counter = max(numbers) + 1
+        
+        # 已有的导航条目保留下来，新书的条目接在后面
+        if nav_href is not None:
+            nav_dir = posixpath.dirname(nav_href)
+            with zip_ref.open(nav_href) as nav:
+                for label, href in self.parse_nav_stream(nav):
+                    path, query, fragment = self.split_reference(href)
+                    self.toc.append((label, self.normalize_path(path, nav_dir) + query + fragment))
+        elif spine:
+            self.toc.append((metadata['title'] or os.path.splitext(os.path.basename(zip_ref.filename or ''))[0],
+                             resources[spine[0]].href))
+        
+        # 已合并的书作为合并元数据时的第一本书；可重现模式下用它的标识符代替内容摘要
+        cover = metadata['cover']
+        self.book_metadata.append({
+            'title': metadata['title'],
+            'creators': metadata['creators'],
+            'series': metadata['series'],
+            'identifier': metadata['identifier'],
+            'cover_href': resources[cover].href if cover in resources else None,
+            'digest': metadata['identifier'] or ''
+        })
+        logger.info(f"已有 {len(spine)} 个spine文档、{len(resources)} 个资源，编号从 "
+                    f"item_{self.resource_counter:04d} 继续")
+    
+    def parse_nav_stream(self, source) -> List[Tuple[str, str]]:
+        """流式解析EPUB 3导航文档，返回目录中第一层的(标题, 路径)"""
+        entries = []
+        in_toc = False
+        depth = 0
+        nav_depth = 0
+        list_depth = 0
+        href = None
+        label_parts = []
+        
+        def start(tag, attrib):
+            nonlocal in_toc, depth, nav_depth, list_depth, href
+            depth += 1
+            if tag == 'nav' and not entries and 'toc' in attrib.get('epub:type', '').split():
+                in_toc = True
+                nav_depth = depth
+            elif in_toc and tag == 'ol':
+                list_depth += 1
+            elif in_toc and tag == 'a' and list_depth == 1 and attrib.get('href'):
+                href = attrib['href']
+                label_parts.clear()
+        
+        def end(tag):
+            nonlocal in_toc, depth, list_depth, href
+            if in_toc and tag == 'ol':
+                list_depth -= 1
+            elif in_toc and tag == 'a' and href is not None:
+                entries.append((' '.join(''.join(label_parts).split()), href))
+                href = None
+            elif in_toc and tag == 'nav' and depth == nav_depth:
+                in_toc = False
+            depth -= 1
+        
+        def data(text):
+            if href is not None:
+                label_parts.append(text)
+        
+        self.parse_xml_stream(source, start, end, data)
+        return entries
+    
+    def book_keys(self, epub_files: List[str]) -> List[bytes]:
+        """每本书对应的输入前缀的键：由影响输出的选项和这本书及之前所有书的(路径, 修改时间, 大小)派生
+        
+        bytes输入按内容哈希；文件对象无法判断内容是否变化，它和之后的书都不复用。
+        """
+        import hashlib
+        options = (self.language, self.prune, sorted(self.metadata_rules.items()), self.title, self.creators,
+                   self.compression_level, self.max_output_size, self.split_every, self.consolidate_size,
+                   self.deterministic, self.dedupe_css, self.subset_fonts, self.keep_layout)
+        digest = hashlib.sha1(repr(options).encode('utf-8'))
+        keys = []
+        for epub_file in epub_files:
+            if isinstance(epub_file, (str, os.PathLike)):
+                digest.update(repr(MergeCache.file_key(epub_file)).encode('utf-8'))
+            elif isinstance(epub_file, (bytes, bytearray, memoryview)):
+                digest.update(hashlib.sha1(epub_file).digest())
+            else:
+                digest.update(os.urandom(16))
+            keys.append(digest.copy().digest())
+        return keys
+    
+    def state_container(self, kind: type):
+        """新建一个本卷状态的容器（dict、set或list）；增量合并时使用能取出每本书改动的容器"""
+        if not self.incremental:
+            return kind()
+        return {dict: JournalDict, set: JournalSet, list: JournalList}[kind]()
+    
+    def journaled_state(self, spine_items: List[str], resources: Dict) -> Tuple:
+        return (self.filename_counter, self.resource_mapping, self.id_mapping, self.reference_graph,
+                self.reachable, self.book_metadata, self.toc, self.consolidated, self.shared_stylesheets,
+                self.codepoints, self.pending_fonts, spine_items, resources)
+    
+    def snapshot_state(self, spine_items: List[str], resources: Dict) -> Tuple:
+        """取出处理一本书期间合并器状态（本卷的映射、引用图、目录等）的改动
+        
+        只记录这本书写入、删除和追加的条目，不复制之前的书留下的状态。
+        """
+        changes = []
+        for container in self.journaled_state(spine_items, resources):
+            container_changes = container.take_changes()
+            if container is self.pending_fonts:
+                # 等待子集化的字体是输入书的成员数据，与记录的成员一样复制出来，不再引用输入书的映射
+                container_changes = [(new_href, detached(data)) for new_href, data in container_changes]
+            changes.append(container_changes)
+        return self.resource_counter, self.pruned_count, self.pruned_bytes, tuple(changes)
+    
+    def restore_state(self, state: Tuple, spine_items: List[str], resources: Dict):
+        """在本卷当前的状态上重放snapshot_state取出的改动；记录本身不被修改，下次合并还能再用"""
+        self.resource_counter, self.pruned_count, self.pruned_bytes, changes = state
+        for container, container_changes in zip(self.journaled_state(spine_items, resources), changes):
+            container.apply_changes(container_changes)
+    
+    def needs_new_part(self, part_books: int, part_size: int, book: BookData) -> bool:
+        """判断是否要在这本书之前开始新的一卷；单本书超过大小上限时单独成卷"""
+        if part_books == 0:
+            return False
+        if self.split_every and part_books >= self.split_every:
+            return True
+        if self.max_output_size and part_size + book.compressed_size > self.max_output_size:
+            return True
+        return False
+    
+    @staticmethod
+    def part_path(output_path: str, part: int) -> str:
+        """第part卷的输出路径，如 merged.epub -> merged_1.epub"""
+        name, ext = os.path.splitext(output_path)
+        return f"{name}_{part}{ext or '.epub'}"
+    
+    def start_part(self, output_path: str, cache: MergeCache) -> EpubWriter:
+        """开始写出一卷：重置本卷的资源映射，写入mimetype和container.xml"""
+        self.resource_counter = 1
+        self.resource_mapping = self.state_container(dict)
+        self.id_mapping = self.state_container(dict)
+        self.filename_counter = self.state_container(dict)
+        self.reference_graph = self.state_container(dict)
+        self.reachable = self.state_container(set)
+        self.book_metadata = self.state_container(list)
+        self.toc = self.state_container(list)
+        self.consolidated = self.state_container(dict)
+        self.shared_stylesheets = self.state_container(dict)
+        self.codepoints = self.state_container(set)
+        self.pending_fonts = self.state_container(list)
+        self.layout_offset = 0
+        
+        writer = EpubWriter(output_path, queue_depth=self.write_queue_depth,
+                            compression_level=self.compression_level, workers=self.compress_workers,
+                            cache=cache,
+                            date_time=self.build_time().timetuple() if self.deterministic else None,
+                            inline=self.profiler is not None)
+        self.output_paths.append(output_path)
+        
+        # mimetype必须是第一个且不压缩
+        writer.add('mimetype', 'application/epub+zip', compress=False)
+        
+        # 创建container.xml
+        container_xml = '''<?xml version="1.0" encoding="UTF-8"?>
 <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
     <rootfiles>
         <rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
     </rootfiles>
 </container>'''
+        writer.add('META-INF/container.xml', container_xml)
+        return writer
+    
+    def finish_part(self, writer: EpubWriter, spine_items: List[str], resources: Dict, split: bool = False):
+        """写入本卷的导航和content.opf并关闭输出文件"""
+        # 按规则合并本卷各书的元数据，分卷时标题后加上卷号
+        metadata = self.merge_metadata(self.book_metadata)
+        if split:
+            metadata['title'] = f"{metadata['title']} ({len(self.output_paths)})"
+        
+        if self.pending_fonts:
+            self.write_fonts(writer)
+        
+        nav_item = OutputItem('nav.xhtml', 'application/xhtml+xml', None, properties='nav')
+        resources['nav'] = nav_item
+        writer.add(nav_item.href, self.create_nav(metadata['title'], self.toc))
+        writer.add('content.opf', self.create_merged_opf(spine_items, resources, metadata))
+        writer.close()
+    
+    def process_book(self, book: BookData, writer: EpubWriter, all_spine_items: List[str], all_resources: Dict):
+        """处理一本输入书：映射并改写资源和spine文档，交给writer写出"""
+        if self.keep_layout:
+            return self.copy_book(book, writer, all_spine_items, all_resources)
+        spine, manifest, metadata = book.spine, book.manifest, book.metadata
+        self.book_metadata.append(metadata)
+        
+        # 压缩包内OPF所在目录，manifest中的路径相对于它
+        base_path = posixpath.dirname(book.opf_name)
+        self.opf_dir = base_path
+        # spine、导航和封面直接引用的资源
+        roots = set()
+        
+        # 首先处理所有资源（图片、CSS等），建立映射关系
+        book_resources = []
+        for item_id in self.classify_manifest(spine, manifest):
+            item_info = manifest[item_id]
+            href = item_info.href
+            media_type = item_info.media_type
             
-            with open(os.path.join(meta_inf_dir, 'container.xml'), 'w', encoding='utf-8') as f:
-                f.write(container_xml)
+            # 生成新的ID
+            new_id = f"item_{self.resource_counter:04d}"
+            self.resource_counter += 1
             
-            # 合并所有EPUB文件
-            all_spine_items = []
-            all_manifest = {}
-            all_resources = {}
+            # 按解码后的文件名生成唯一的成员名，写进OPF和引用时再按URL编码
+            path = self.normalize_path(href, base_path)
+            unique_filename = self.get_unique_filename(posixpath.basename(path))
+            new_href = f"resources/{unique_filename}"
             
-            # 重置全局资源映射
-            self.resource_mapping = {}
-            self.id_mapping = {}
-            self.filename_counter = {}
+            # 建立映射关系（使用压缩包内的路径）
+            self.resource_mapping[path] = new_href
+            self.id_mapping[item_id] = new_id
             
-            for i, epub_file in enumerate(epub_files):
-                logger.info(f"处理第 {i+1} 个文件: {epub_file}")
-                
-                # 解压EPUB
-                temp_dir = self.extract_epub(epub_file)
+            logger.info(f"资源映射: {path} -> {new_href} (类型: {media_type})")
+            
+            all_resources[new_id] = OutputItem(new_href, media_type, href)
+            book_resources.append((new_id, path, new_href, item_info))
+            
+            # 导航文档和NCX作为引用图的根
+            if 'nav' in item_info.properties.split() or media_type == 'application/x-dtbncx+xml':
+                roots.add(new_href)
+        
+        # spine文档的新ID也先分配好，资源和章节中指向其他章节的链接都能改写
+        spine_ids = {}
+        for item_id in spine:
+            spine_ids[item_id] = f"item_{self.resource_counter:04d}"
+            self.resource_counter += 1
+            self.resource_mapping[self.normalize_path(manifest[item_id].href, base_path)] = f'{spine_ids[item_id]}.xhtml'
+        if self.consolidate_size:
+            groups = self.group_chapters(book, spine_ids)
+        else:
+            groups = [[item_id] for item_id in spine]
+        
+        # 映射建立完成后再取资源数据，样式表和XHTML资源中的引用同时改写；
+        # 样式表先改写，与已输出的样式表共用时的映射对之后改写的文档都生效
+        shared_indexes = set()
+        css_references = set()
+        rewrite_order = sorted(range(len(book_resources)),
+                               key=lambda index: book_resources[index][3].media_type != 'text/css')
+        for index in rewrite_order:
+            new_id, path, new_href, item_info = book_resources[index]
+            href = item_info.href
+            if href not in book.members:
+                data = None
+            elif item_info.media_type in REWRITTEN_MEDIA_TYPES:
+                data = self.rewrite_text_resource(book, href, new_href, item_info.media_type)
+                if item_info.media_type == 'text/css' and self.dedupe_css:
+                    shared_href = self.share_stylesheet(data, new_href, book.index, css_references)
+                    if shared_href is not None:
+                        logger.info(f"样式表与 {shared_href} 相同，共用一份: {path}")
+                        self.resource_mapping[path] = shared_href
+                        del all_resources[new_id]
+                        shared_indexes.add(index)
+                    css_references |= self.reference_graph[new_href]
+            else:
+                data = book.members[href]
+            book_resources[index] = (new_id, path, new_href, data)
+        if shared_indexes:
+            book_resources = [entry for index, entry in enumerate(book_resources) if index not in shared_indexes]
+        
+        # 记录封面在合并后的路径，第一个封面作为输出封面时也是引用图的根
+        if metadata['cover']:
+            metadata['cover_href'] = self.resource_mapping[self.normalize_path(manifest[metadata['cover']].href,
+                                                                               base_path)]
+            if (self.metadata_rules['cover'] == 'first'
+                    and not any(m.get('cover_href') for m in self.book_metadata[:-1])):
+                roots.add(metadata['cover_href'])
+        
+        # 然后处理spine项目（HTML文件），拼接的章节写成一个文档
+        for group in groups:
+            contents = []
+            for item_id in group:
+                item_info = manifest[item_id]
+                href = item_info.href
+                media_type = item_info.media_type
                 
-                try:
-                    # 解析content.opf
-                    opf_path = self.parse_container_xml(temp_dir)
-                    spine, manifest = self.parse_content_opf(opf_path)
-                    
-                    # 获取基础路径
-                    base_path = os.path.dirname(opf_path)
-                    
-                    # 首先处理所有资源（图片、CSS等），建立映射关系
-                    for item_id, item_info in manifest.items():
-                        if item_id not in spine:  # 不是spine项目
-                            href = item_info['href']
-                            media_type = item_info['media-type']
-                            
-                            # 生成新的ID
-                            new_id = f"item_{self.resource_counter:04d}"
-                            self.resource_counter += 1
-                            
-                            # 生成唯一的文件名
-                            original_filename = os.path.basename(href)
-                            unique_filename = self.get_unique_filename(original_filename)
-                            new_href = f"resources/{unique_filename}"
-                            
-                            # 复制文件到resources目录
-                            self.copy_resource(base_path, href, merged_temp_dir, new_href)
-                            
-                            # 建立映射关系（使用文件内的相对路径）
-                            self.resource_mapping[href] = new_href
-                            self.id_mapping[item_id] = new_id
-                            
-                            logger.info(f"资源映射: {href} -> {new_href} (类型: {media_type})")
-                            
-                            all_resources[new_id] = {
-                                'href': new_href,
-                                'media_type': media_type,
-                                'original_href': href
-                            }
-                    
-                    # 然后处理spine项目（HTML文件）
-                    for item_id in spine:
-                        if item_id in manifest:
-                            item_info = manifest[item_id]
-                            href = item_info['href']
-                            media_type = item_info['media-type']
-                            
-                            # 生成新的ID
-                            new_id = f"item_{self.resource_counter:04d}"
-                            self.resource_counter += 1
-                            
-                            # 读取文件内容
-                            content = self.read_file_content(base_path, href)
-                            
-                            # 如果是HTML文件，需要更新资源引用
-                            if media_type == 'application/xhtml+xml':
-                                logger.info(f"处理HTML文件: {href}")
-                                # 使用全局资源映射
-                                content = self.update_html_references(content, base_path, self.resource_mapping)
-                            
-                            # 保存到合并的资源中
-                            all_resources[new_id] = {
-                                'content': content,
-                                'media_type': media_type,
-                                'original_href': href
-                            }
-                            
-                            all_spine_items.append(new_id)
+                # 读取文件内容
+                content = self.read_text_member(book, href)
                 
-                finally:
-                    # 清理临时目录
-                    shutil.rmtree(temp_dir)
+                # 如果是HTML文件，需要更新资源引用（相对于文件自身所在的目录）
+                if media_type == 'application/xhtml+xml':
+                    logger.info(f"处理HTML文件: {href}")
+                    # 使用全局资源映射
+                    chapter_dir = posixpath.dirname(self.normalize_path(href, base_path))
+                    content = self.update_html_references(content, chapter_dir, self.resource_mapping,
+                                                          references=roots)
+                if self.subset_fonts:
+                    self.collect_codepoints(content)
+                contents.append(content)
             
-            # 创建合并后的content.opf
-            self.create_merged_opf(merged_temp_dir, all_spine_items, all_resources)
+            if len(group) > 1:
+                logger.info(f"拼接 {len(group)} 个章节: {spine_ids[group[0]]}.xhtml")
+                content = self.join_chapters(contents, [self.consolidated[f'{spine_ids[item_id]}.xhtml']
+                                                        for item_id in group])
             
-            # 创建EPUB文件
-            self.create_epub(merged_temp_dir, output_path)
+            # 交给writer写出
+            new_id = spine_ids[group[0]]
+            item_info = manifest[group[0]]
+            output_item = OutputItem(f'{new_id}.xhtml', item_info.media_type, item_info.href)
+            writer.add(output_item.href, content)
+            all_resources[new_id] = output_item
+            all_spine_items.append(new_id)
             
-            logger.info(f"合并完成，输出文件: {output_path}")
+            # 每本书的第一个spine文档作为导航中的条目
+            if group[0] == spine[0]:
+                title = metadata['title'] or os.path.splitext(os.path.basename(book.path))[0]
+                self.toc.append((title, output_item.href))
+        
+        # 裁剪未被引用的资源
+        if self.prune:
+            book_resources = self.prune_book_resources(book_resources, all_resources, roots)
+        
+        for new_id, path, new_href, data in book_resources:
+            if data is None:
+                continue
+            if self.subset_fonts and self.is_font(all_resources[new_id]):
+                # 本卷所有正文处理完、用到的字符确定后再裁剪写出
+                self.pending_fonts.append((new_href, data))
+                continue
+            writer.add(new_href, data)
+            logger.info(f"复制资源: {path} -> {new_href}")
+    
+    def copy_book(self, book: BookData, writer: EpubWriter, all_spine_items: List[str], all_resources: Dict):
+        """保留原有目录结构处理一本输入书：成员原样写到book_NNN/下，书内的引用都不用改写，
+        只为合并后的OPF分配新ID
+        """
+        spine, manifest, metadata = book.spine, book.manifest, book.metadata
+        self.book_metadata.append(metadata)
+        
+        base_path = posixpath.dirname(book.opf_name)
+        prefix = f"book_{book.index + 1 + self.layout_offset:03d}/"
+        logger.info(f"保留目录结构: {book.path} -> {prefix}")
+        
+        new_ids = {}
+        for item_id, item_info in manifest.items():
+            data = book.members.get(item_info.href)
+            if data is None:
+                continue
+            new_id = f"item_{self.resource_counter:04d}"
+            self.resource_counter += 1
+            new_ids[item_id] = new_id
+            self.id_mapping[item_id] = new_id
             
-        finally:
-            # 清理临时目录
-            shutil.rmtree(merged_temp_dir)
+            # 成员名保持压缩包内的路径，写进OPF时再按URL编码
+            path = self.normalize_path(item_info.href, base_path)
+            new_href = prefix + path
+            self.resource_mapping[path] = new_href
+            # 书自己的导航文档作为普通资源，封面由合并后的元数据另行标记
+            properties = ' '.join(p for p in item_info.properties.split() if p not in ('nav', 'cover-image'))
+            all_resources[new_id] = OutputItem(new_href, item_info.media_type, item_info.href, properties)
+            writer.add(new_href, data)
+        
+        all_spine_items.extend(new_ids[item_id] for item_id in spine if item_id in new_ids)
+        if metadata['cover'] in new_ids:
+            metadata['cover_href'] = all_resources[new_ids[metadata['cover']]].href
+        
+        # 每本书的第一个spine文档作为导航中的条目
+        first = next((item_id for item_id in spine if item_id in new_ids), None)
+        if first is not None:
+            title = metadata['title'] or os.path.splitext(os.path.basename(book.path))[0]
+            self.toc.append((title, all_resources[new_ids[first]].href))
+    
+    @staticmethod
+    def is_font(item: OutputItem) -> bool:
+        return item.media_type in FONT_MEDIA_TYPES or item.href.lower().endswith(FONT_EXTENSIONS)
+    
+    def collect_codepoints(self, content: str):
+        """记录文档中出现的字符（字符引用先还原），标签和属性中的ASCII字符也会计入"""
+        if '&' in content:
+            from html import unescape
+            content = unescape(content)
+        self.codepoints.update(content)
+    
+    def write_fonts(self, writer: EpubWriter):
+        """把本卷的嵌入字体裁剪为正文用到的字符后写出
+        
+        未安装fontTools时警告并原样写出；多个字体在进程池中并行裁剪，结果按(字体哈希, 字符集哈希)缓存。
+        无法解析（如经过混淆）或裁剪后没有变小的字体原样写出。
+        """
+        import hashlib
+        import importlib.util
+        fonts = self.pending_fonts
+        self.pending_fonts = []
+        if importlib.util.find_spec('fontTools') is None:
+            logger.warning("未安装fontTools（pip install fonttools），跳过字体子集化")
+            for new_href, data in fonts:
+                writer.add(new_href, data)
+            return
+        
+        # 常用ASCII字符总是保留，阅读器界面可能用到
+        unicodes = tuple(sorted({ord(char) for char in self.codepoints} | set(range(0x20, 0x7F))))
+        unicodes_key = hashlib.sha1(','.join(map(str, unicodes)).encode('ascii')).digest()
+        
+        originals = []
+        for new_href, data in fonts:
+            if isinstance(data, RawMember):
+                data = bytes(data.raw) if data.compress_type == ZIP_STORED else zlib.decompress(data.raw, -15)
+            else:
+                data = bytes(data)
+            originals.append((new_href, data, (hashlib.sha1(data).digest(), unicodes_key)))
+        
+        # 缓存中没有的字体并行裁剪；只有一个时直接在本进程中裁剪，省去启动进程的开销
+        missing = [(data, key) for _, data, key in originals if key not in self.font_cache]
+        missing = list({key: data for data, key in missing}.items())
+        if len(missing) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(len(missing), os.cpu_count() or 1)) as pool:
+                futures = [(key, pool.submit(subset_font, data, unicodes)) for key, data in missing]
+                results = []
+                for key, future in futures:
+                    try:
+                        results.append((key, future.result()))
+                    except Exception as e:
+                        results.append((key, e))
+        else:
+            results = []
+            for key, data in missing:
+                try:
+                    results.append((key, subset_font(data, unicodes)))
+                except Exception as e:
+                    results.append((key, e))
+        for key, result in results:
+            self.font_cache[key] = result
+        
+        for new_href, data, key in originals:
+            result = self.font_cache[key]
+            if isinstance(result, Exception):
+                logger.warning(f"字体子集化失败，原样写出: {new_href}: {result}")
+            elif len(result) < len(data):
+                logger.info(f"字体子集化: {new_href} {len(data)} -> {len(result)} 字节")
+                self.font_saved_bytes += len(data) - len(result)
+                data = result
+            writer.add(new_href, data)
+    
+    def group_chapters(self, book: BookData, spine_ids: Dict[str, str]) -> List[List[str]]:
+        """把同一本书中连续的小XHTML章节分组，每组总大小不超过consolidate_size
+        
+        多于一个章节的组会拼接成一个文档（以组内第一个章节的新路径命名），每个章节成为其中的一节，
+        节ID即章节原本的新ID；与组内之前章节重复的元素ID加上节ID前缀。
+        分组结果记录到self.consolidated，供改写链接时把指向章节的链接改为指向对应的节。
+        """
+        groups = []
+        group_size = 0
+        joinable = False
+        for item_id, new_id in spine_ids.items():
+            item_info = book.manifest[item_id]
+            size = len(book.members.get(item_info.href, b''))
+            # 只拼接有body的XHTML文档
+            can_join = (item_info.media_type == 'application/xhtml+xml'
+                        and re.search(r'<body[\s>]', self.read_text_member(book, item_info.href), re.IGNORECASE))
+            if can_join and joinable and group_size + size <= self.consolidate_size:
+                groups[-1].append(item_id)
+                group_size += size
+            else:
+                groups.append([item_id])
+                group_size = size
+            joinable = bool(can_join)
+        
+        for group in groups:
+            if len(group) == 1:
+                continue
+            target = f'{spine_ids[group[0]]}.xhtml'
+            used = {spine_ids[item_id] for item_id in group}
+            for item_id in group:
+                section_id = spine_ids[item_id]
+                content = self.read_text_member(book, book.manifest[item_id].href)
+                id_map = {}
+                body_id = re.search(r'<body\b[^>]*?(?<![\w-])id=["\']([^"\']*)["\']', content, re.IGNORECASE)
+                if body_id:
+                    # body不会保留，指向它的链接改为指向节本身
+                    id_map[body_id.group(1)] = section_id
+                body_start = re.search(r'<body[^>]*>', content, re.IGNORECASE).end()
+                for element_id in re.findall(r'(?<![\w-])id=["\']([^"\']*)["\']', content[body_start:]):
+                    if element_id in id_map:
+                        continue
+                    new_element_id = element_id
+                    if element_id in used:
+                        new_element_id = f'{section_id}_{element_id}'
+                    id_map[element_id] = new_element_id
+                    used.add(new_element_id)
+                self.consolidated[f'{section_id}.xhtml'] = (target, section_id, id_map)
+        return groups
+    
+    def join_chapters(self, contents: List[str], sections: List[Tuple[str, str, Dict]]) -> str:
+        """把几个已改写的章节拼接为一个XHTML文档
+        
+        使用第一个章节的文档头，并补上其他章节head中的样式表和样式；每个章节的body内容放进
+        一个以节ID为id的div中（body的class等属性移到div上），元素ID和页内锚点按重命名表改写。
+        """
+        first = contents[0]
+        head = first[:re.search(r'<body[^>]*>', first, re.IGNORECASE).start()]
+        tail_start = first.lower().rfind('</body>')
+        tail = first[tail_start + len('</body>'):] if tail_start >= 0 else '\n</html>'
+        
+        # 其他章节引用的样式表和内联样式
+        extra_head = []
+        for content in contents[1:]:
+            chapter_head = content[:re.search(r'<body[^>]*>', content, re.IGNORECASE).start()]
+            for element in re.findall(r'<link\b[^>]*>|<style\b.*?</style>', chapter_head, re.IGNORECASE | re.DOTALL):
+                if element not in head and element not in extra_head:
+                    extra_head.append(element)
+        if extra_head:
+            head_end = head.lower().rfind('</head>')
+            if head_end >= 0:
+                head = head[:head_end] + ''.join(f'{element}\n' for element in extra_head) + head[head_end:]
+        
+        parts = [head, '<body>\n']
+        for content, (_, section_id, id_map) in zip(contents, sections):
+            body = re.search(r'<body([^>]*)>', content, re.IGNORECASE)
+            body_end = content.lower().rfind('</body>')
+            inner = content[body.end():body_end if body_end >= 0 else len(content)]
+            attributes = re.sub(r'\sid=["\'][^"\']*["\']', '', body.group(1))
+            
+            def rename_id(match):
+                return f'{match.group(1)}{id_map.get(match.group(2), match.group(2))}{match.group(3)}'
+            
+            def rename_anchor(match):
+                return f'{match.group(1)}#{id_map.get(match.group(2), match.group(2))}{match.group(3)}'
+            
+            inner = re.sub(r'((?<![\w-])id=["\'])([^"\']*)(["\'])', rename_id, inner)
+            inner = re.sub(r'((?<![\w-])href=["\'])#([^"\']*)(["\'])', rename_anchor, inner, flags=re.IGNORECASE)
+            parts.append(f'<div id="{section_id}"{attributes}>{inner}</div>\n')
+        parts.append('</body>')
+        parts.append(tail)
+        return ''.join(parts)
+    
+    def build_time(self) -> 'datetime':
+        """输出的修改时间（UTC）：可重现模式下使用SOURCE_DATE_EPOCH，未设置时为1980-01-01（ZIP能表示的最早时间）"""
+        from datetime import datetime, timezone
+        if not self.deterministic:
+            return datetime.now(timezone.utc)
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch:
+            return max(datetime.fromtimestamp(int(epoch), timezone.utc), datetime(1980, 1, 1, tzinfo=timezone.utc))
+        return datetime(1980, 1, 1, tzinfo=timezone.utc)
+    
+    def merge_metadata(self, book_metadata: List[Dict]) -> Dict:
+        """按合并规则把各输入书的元数据合并为输出书的元数据"""
+        import uuid
+        
+        titles = [m['title'] for m in book_metadata if m['title']]
+        series_names = {m['series'] for m in book_metadata if m['series']}
+        series = series_names.pop() if len(series_names) == 1 else None
+        
+        # 标题
+        title_rule = self.metadata_rules['title']
+        if self.title:
+            title = self.title
+        elif title_rule == 'series' and series and len(book_metadata) > 1:
+            title = series
+        elif title_rule == 'join' and titles:
+            title = ' / '.join(titles)
+        elif titles:
+            title = titles[0]
+        else:
+            title = '合并的EPUB文件'
+        
+        # 作者
+        if self.creators:
+            creators = list(self.creators)
+        elif self.metadata_rules['creators'] == 'first':
+            creators = next((m['creators'] for m in book_metadata if m['creators']), [])
+        else:
+            creators = []
+            for m in book_metadata:
+                for creator in m['creators']:
+                    if creator not in creators:
+                        creators.append(creator)
+        
+        # 封面
+        cover_href = None
+        if self.metadata_rules['cover'] == 'first':
+            cover_href = next((m['cover_href'] for m in book_metadata if m.get('cover_href')), None)
+        
+        # 由输入书的标识符（没有时用标题）派生稳定的UUID，相同输入得到相同标识符；
+        # 可重现模式下改用输入书的内容摘要，内容不同的输入不会得到相同的标识符
+        if self.deterministic:
+            source_keys = [m.get('digest', '') for m in book_metadata]
+        else:
+            source_keys = [m['identifier'] or m['title'] or '' for m in book_metadata]
+        identifier = uuid.uuid5(uuid.NAMESPACE_URL, 'epub-merger:' + '\n'.join(source_keys))
+        
+        return {
+            'title': title,
+            'creators': creators,
+            'series': series,
+            'identifier': f'urn:uuid:{identifier}',
+            'modified': self.build_time().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'cover_href': cover_href
+        }
     
-    def create_merged_opf(self, temp_dir: str, spine_items: List[str], resources: Dict):
-        """创建合并后的content.opf文件"""
+    def create_merged_opf(self, spine_items: List[str], resources: Dict, metadata: Dict = None) -> str:
+        """创建合并后的content.opf内容"""
+        from html import escape
+        
+        if metadata is None:
+            metadata = self.merge_metadata(self.book_metadata)
+        
+        metadata_content = f'        <dc:title>{escape(metadata["title"])}</dc:title>\n'
+        for creator in metadata['creators']:
+            metadata_content += f'        <dc:creator>{escape(creator)}</dc:creator>\n'
+        metadata_content += f'        <dc:language>{escape(self.language)}</dc:language>\n'
+        metadata_content += f'        <dc:identifier id="uid">{escape(metadata["identifier"])}</dc:identifier>\n'
+        metadata_content += f'        <meta property="dcterms:modified">{metadata["modified"]}</meta>\n'
+        if metadata['series']:
+            metadata_content += f'        <meta property="belongs-to-collection" id="series">{escape(metadata["series"])}</meta>\n'
+            metadata_content += '        <meta refines="#series" property="collection-type">series</meta>\n'
+            metadata_content += f'        <meta name="calibre:series" content="{escape(metadata["series"])}"/>\n'
+        
+        # 封面图片
+        cover_id = None
+        if metadata['cover_href']:
+            cover_id = next((item_id for item_id, item_info in resources.items()
+                             if item_info.href == metadata['cover_href']), None)
+        if cover_id:
+            metadata_content += f'        <meta name="cover" content="{cover_id}"/>\n'
+        
         opf_content = f'''<?xml version="1.0" encoding="UTF-8"?>
 <package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="uid">
     <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
-        <dc:title>合并的EPUB文件</dc:title>
-        <dc:creator>EPUB合并工具</dc:creator>
-        <dc:language>{self.language}</dc:language>
-        <dc:identifier id="uid">merged-epub-{self.resource_counter}</dc:identifier>
-    </metadata>
+{metadata_content}    </metadata>
     <manifest>
 '''
         
-        # 添加所有资源到manifest
+        # 添加所有资源到manifest：先收集再join，逐项拼接在记录性能（cProfile）时会退化为平方时间
+        items = []
         for item_id, item_info in resources.items():
-            if 'href' in item_info:
-                # 文件资源
-                opf_content += f'        <item id="{item_id}" href="{item_info["href"]}" media-type="{item_info["media_type"]}"/>\n'
-            else:
-                # 内容资源
-                opf_content += f'        <item id="{item_id}" href="{item_id}.xhtml" media-type="{item_info["media_type"]}"/>\n'
+            properties = item_info.properties.split()
+            if item_id == cover_id:
+                properties.append('cover-image')
+            properties = f' properties="{escape(" ".join(properties))}"' if properties else ''
+            items.append(f'        <item id="{item_id}" href="{escape(self.url_path(item_info.href))}" '
+                         f'media-type="{escape(item_info.media_type)}"{properties}/>\n')
+        opf_content += ''.join(items)
         
         opf_content += '''    </manifest>
     <spine>
 '''
         
         # 添加spine项目
-        for item_id in spine_items:
-            opf_content += f'        <itemref idref="{item_id}"/>\n'
+        opf_content += ''.join(f'        <itemref idref="{item_id}"/>\n' for item_id in spine_items)
         
         opf_content += '''    </spine>
 </package>'''
         
-        # 写入content.opf
-        with open(os.path.join(temp_dir, 'content.opf'), 'w', encoding='utf-8') as f:
-            f.write(opf_content)
+        return opf_content
+    
+    def create_nav(self, title: str, toc: List[Tuple[str, str]]) -> str:
+        """创建EPUB 3导航文档，每本输入书一个条目，指向该书的第一个spine文档"""
+        from html import escape
         
-        # 写入所有内容文件
-        for item_id, item_info in resources.items():
-            if 'content' in item_info:
-                content_file = os.path.join(temp_dir, f'{item_id}.xhtml')
-                with open(content_file, 'w', encoding='utf-8') as f:
-                    f.write(item_info['content'])
-    
-    def create_epub(self, temp_dir: str, output_path: str):
-        """创建最终的EPUB文件"""
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)
-                    zipf.write(file_path, arcname)
-
-def main():
-    parser = argparse.ArgumentParser(description='合并多个EPUB文件')
-    parser.add_argument('input_files', nargs='+', help='输入的EPUB文件列表')
-    parser.add_argument('-o', '--output', default='merged.epub', help='输出文件名')
+        entries = []
+        for label, href in toc:
+            path, query, fragment = self.split_reference(href)
+            href = self.url_path(path) + query + fragment
+            entries.append(f'            <li><a href="{escape(href)}">{escape(label)}</a></li>\n')
+        entries = ''.join(entries)
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="{escape(self.language)}" lang="{escape(self.language)}">
+<head>
+    <title>{escape(title)}</title>
+</head>
+<body>
+    <nav epub:type="toc" id="toc">
+        <h1>{escape(title)}</h1>
+        <ol>
+{entries}        </ol>
+    </nav>
+</body>
+</html>'''
+
+def main(argv: List[str] = None):
+    """命令行入口，返回进程的退出状态：成功为0，输入文件有问题或合并失败为1"""
+    if argv is None:
+        argv = sys.argv[1:]
+    
+    # 设置日志
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    # 常驻服务模式
+    if argv[:1] == ['serve']:
+        from epub_merger_server import serve_main
+        return serve_main(argv[1:])
+    
+    import argparse
+    parser = argparse.ArgumentParser(description='合并多个EPUB文件（常驻服务模式: epub_merger.py serve -h）')
+    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
+    parser.add_argument('input_files', nargs='*', help='输入的EPUB文件列表')
+    parser.add_argument('-o', '--output', help='输出文件名 (默认: merged.epub，追加时为被追加的文件)')
     parser.add_argument('-l', '--language', default='zh-CN', 
                        help='输出EPUB的语言代码 (默认: zh-CN, 例如: en-US, ja-JP, ko-KR)')
+    parser.add_argument('--title', help='输出EPUB的标题（默认按 --title-rule 从输入书合并）')
+    parser.add_argument('--creator', action='append', dest='creators',
+                       help='输出EPUB的作者，可重复指定（默认按 --creator-rule 从输入书合并）')
+    parser.add_argument('--title-rule', choices=['series', 'first', 'join'], default='series',
+                       help='标题合并规则: series=同一系列时用系列名, first=第一本书名, join=拼接所有书名 (默认: series)')
+    parser.add_argument('--creator-rule', choices=['union', 'first'], default='union',
+                       help='作者合并规则: union=合并去重, first=第一本书的作者 (默认: union)')
+    parser.add_argument('--cover-rule', choices=['first', 'none'], default='first',
+                       help='封面规则: first=第一个有封面的书的封面, none=不设置封面 (默认: first)')
+    parser.add_argument('--append-to', metavar='EPUB',
+                       help='把输入的书追加到之前合并好的EPUB末尾：已有内容原样复制，只处理新书')
+    parser.add_argument('--watch', metavar='DIR',
+                       help='监视目录：目录中的EPUB文件（按文件名自然排序）变化后自动重新合并，未变化的书复用缓存')
+    parser.add_argument('--watch-interval', type=float, default=1.0, metavar='SECONDS',
+                       help='监视目录的轮询间隔，单位秒 (默认: 1)')
+    parser.add_argument('--watch-debounce', type=float, default=2.0, metavar='SECONDS',
+                       help='文件变化后等待多久不再变化才开始合并，单位秒 (默认: 2)')
+    parser.add_argument('--check', action='store_true',
+                       help='只检查输入文件（不解压、不合并）：确认结构完整、成员可解压，并估算输出大小')
+    parser.add_argument('--prune', action='store_true',
+                       help='裁剪spine、导航和封面都未引用的资源（字体、图片等）')
+    parser.add_argument('--max-output-size', type=int, default=None, metavar='MB',
+                       help='分卷输出：每卷的大小上限，单位MB（按输入书压缩后的大小估算，在书与书之间切分）')
+    parser.add_argument('--split-every', type=int, default=None, metavar='N',
+                       help='分卷输出：每N本书一卷')
+    parser.add_argument('--consolidate', type=int, default=None, metavar='KB',
+                       help='把同一本书中连续的小章节拼接成不超过该大小（KB）的文档，减少文件数和spine条目')
+    parser.add_argument('--deterministic', action='store_true',
+                       help='可重现输出：固定时间戳（可用SOURCE_DATE_EPOCH指定），标识符由输入内容派生，相同输入得到逐字节相同的文件')
+    parser.add_argument('--dedupe-css', action='store_true',
+                       help='规范化样式表并去掉重复规则，各书中规范化后相同的样式表只输出一份')
+    parser.add_argument('--subset-fonts', action='store_true',
+                       help='把嵌入字体裁剪为只含正文用到的字符（需要安装fontTools）')
+    parser.add_argument('--compression-level', type=int, default=-1, choices=range(-1, 10), metavar='{-1..9}',
+                       help='输出的deflate压缩级别，-1为zlib默认，9为最高压缩 (默认: -1)')
+    parser.add_argument('--compress-workers', type=int, default=None, metavar='N',
+                       help='并行压缩输出成员的线程数 (默认: CPU核数)')
+    parser.add_argument('--profile', metavar='FILE',
+                       help='用cProfile记录合并的耗时并写到FILE（可用snakeviz查看），各阶段和各本书分别归类；记录时不再并行预读和压缩')
+    parser.add_argument('--trace-memory', metavar='FILE',
+                       help='用tracemalloc记录各阶段和各本书新增内存最多的分配位置和内存峰值，以JSON写到FILE')
+    parser.add_argument('--read-workers', type=int, default=1, metavar='N',
+                       help='同时读取输入书的线程数，多于1时按中央目录中的大小先读大书，仍按输入顺序合并 (默认: 1)')
+    parser.add_argument('--keep-layout', action='store_true',
+                       help='保留每本书原有的目录结构（放在book_001/等目录下），书的内容原样复制，只重新生成OPF和导航')
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                       help='后台预读的书数 (默认: 2)')
+    parser.add_argument('--prefetch-memory', type=int, default=256, metavar='MB',
+                       help='预读的书占用内存上限，单位MB (默认: 256)')
+    
+    args = parser.parse_args(argv)
+    if args.output is None:
+        args.output = args.append_to or 'merged.epub'
     
-    args = parser.parse_args()
+    # 监视目录
+    if args.watch:
+        if args.input_files:
+            parser.error('--watch 不能与输入文件同时使用')
+        if args.append_to:
+            parser.error('--watch 不能与 --append-to 同时使用')
+        return watch_main(args)
+    if not args.input_files:
+        parser.error('需要指定输入的EPUB文件')
     
     # 检查输入文件
     for epub_file in args.input_files:
         if not os.path.exists(epub_file):
             logger.error(f"文件不存在: {epub_file}")
-            return
+            return 1
+    
+    # 只检查输入文件
+    if args.check:
+        return check_main(args)
+    
+    if args.append_to and not os.path.exists(args.append_to):
+        logger.error(f"文件不存在: {args.append_to}")
+        return 1
     
     # 创建合并器并执行合并
-    merger = EpubMerger(language=args.language)
+    merger = create_merger(args)
     try:
-        merger.merge_epub(args.input_files, args.output)
-        print(f"✅ 合并成功！输出文件: {args.output}")
+        if args.append_to:
+            output_paths = merger.append_epub(args.append_to, args.input_files, args.output)
+        else:
+            output_paths = merger.merge_epub(args.input_files, args.output)
+        print(f"✅ 合并成功！输出文件: {', '.join(output_paths)}")
         print(f"🌍 语言设置: {args.language}")
+        if args.prune:
+            print(f"✂️ 裁剪资源: {merger.pruned_count} 个，节省 {merger.pruned_bytes} 字节")
+        if args.subset_fonts:
+            print(f"🔤 字体子集化节省 {merger.font_saved_bytes} 字节")
+        if merger.profiler is not None:
+            print_profile(merger.profiler)
     except Exception as e:
         logger.error(f"合并失败: {str(e)}")
         print(f"❌ 合并失败: {str(e)}")
+        return 1
+    return 0
+
+def create_merger(args, cache: MergeCache = None, incremental: bool = False) -> EpubMerger:
+    """按命令行参数创建合并器"""
+    metadata_rules = {'title': args.title_rule, 'creators': args.creator_rule, 'cover': args.cover_rule}
+    return EpubMerger(language=args.language, prune=args.prune, metadata_rules=metadata_rules,
+                      title=args.title, creators=args.creators, prefetch_depth=args.prefetch,
+                      prefetch_memory=args.prefetch_memory * 1024 * 1024, read_workers=args.read_workers,
+                      compression_level=args.compression_level, compress_workers=args.compress_workers,
+                      cache=cache,
+                      max_output_size=args.max_output_size * 1024 * 1024 if args.max_output_size else None,
+                      split_every=args.split_every,
+                      consolidate_size=args.consolidate * 1024 if args.consolidate else None,
+                      deterministic=args.deterministic, dedupe_css=args.dedupe_css,
+                      subset_fonts=args.subset_fonts, incremental=incremental,
+                      profile_path=args.profile, trace_memory=args.trace_memory, keep_layout=args.keep_layout)
+
+
+def print_profile(profiler: MergeProfiler):
+    """输出各阶段的耗时和内存，以及自身耗时最多的函数"""
+    print("⏱️ 各阶段耗时:")
+    for record in profiler.phases:
+        line = f"    {record['phase']} {record['name']}: {record['seconds']:.3f} 秒"
+        if 'peak' in record:
+            line += (f"，新增内存 {record['allocated'] / 1048576:.1f} MB，"
+                     f"峰值 {record['peak'] / 1048576:.1f} MB")
+        print(line)
+        for site, size in record.get('top_allocations', []):
+            print(f"        {size / 1024:.1f} KB  {site}")
+    hotspots = profiler.hotspots()
+    if hotspots:
+        print("🔥 自身耗时最多的函数:")
+        for func, calls, tottime, cumtime in hotspots:
+            print(f"    {tottime:.3f} 秒 (累计 {cumtime:.3f} 秒, {calls} 次)  {func}")
+        print(f"📈 完整记录已写入 {profiler.profile_path}，可用 snakeviz {profiler.profile_path} 查看")
+    if profiler.trace_memory and not isinstance(profiler.trace_memory, bool):
+        print(f"📈 内存记录已写入 {profiler.trace_memory}")
+
+
+def watch_main(args) -> int:
+    """--watch模式：目录中的EPUB变化后重新合并，直到按Ctrl+C退出
+    
+    同一个合并器和缓存在各次合并之间共享：从第一本书起未变化的书直接重放上次的处理结果，不再读取；
+    之后的书不再重新解析未变化的OPF，内容未变的成员直接使用缓存的压缩结果，样式表和字体子集化的结果也会复用。
+    先写到临时文件，成功后再替换输出，合并失败时保留上一次的输出。
+    """
+    if not os.path.isdir(args.watch):
+        logger.error(f"目录不存在: {args.watch}")
+        return 1
+    merger = create_merger(args, cache=MergeCache(), incremental=True)
+    name, ext = os.path.splitext(args.output)
+    temp_output = f"{name}.partial{ext or '.epub'}"
+    outputs = []
+    # 输出文件、之前留下的分卷和临时文件都不作为输入
+    watcher = FolderWatcher(args.watch, interval=args.watch_interval, debounce=args.watch_debounce,
+                            exclude={os.path.abspath(args.output), os.path.abspath(temp_output)},
+                            exclude_patterns=[FolderWatcher.output_pattern(args.output)])
+    print(f"👀 正在监视 {args.watch}，按Ctrl+C退出")
+    try:
+        for epub_files in watcher.changes():
+            if not epub_files:
+                print("📭 目录中没有EPUB文件")
+                continue
+            start = time.perf_counter()
+            hits = merger.cache.snapshot()['compressed_hits']
+            try:
+                temp_paths = merger.merge_epub(epub_files, temp_output)
+            except Exception as e:
+                logger.error(f"合并失败: {str(e)}")
+                print(f"❌ 合并失败，保留上一次的输出: {str(e)}")
+                continue
+            
+            # 分卷时临时文件为 name.partial_1.epub……，对应输出 name_1.epub……
+            if temp_paths == [temp_output]:
+                new_outputs = [args.output]
+            else:
+                new_outputs = [merger.part_path(args.output, part) for part in range(1, len(temp_paths) + 1)]
+            for temp_path, output_path in zip(temp_paths, new_outputs):
+                os.replace(temp_path, output_path)
+            # 卷数变少时删除多出来的旧分卷
+            for output_path in outputs:
+                if output_path not in new_outputs and os.path.exists(output_path):
+                    os.remove(output_path)
+            outputs = new_outputs
+            watcher.exclude.update(os.path.abspath(path) for path in outputs)
+            
+            hits = merger.cache.snapshot()['compressed_hits'] - hits
+            print(f"✅ 已合并 {len(epub_files)} 个文件（{time.perf_counter() - start:.1f} 秒，"
+                  f"复用 {merger.reused_books} 本书的处理结果和 {hits} 个压缩结果）: {', '.join(outputs)}")
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def check_main(args) -> int:
+    """--check模式：检查所有输入文件并输出报告，有问题时返回1"""
+    merger = EpubMerger(language=args.language)
+    reports = merger.check_epubs(args.input_files)
+    total_size = 0
+    failed = 0
+    for report in reports:
+        total_size += report['estimated_size']
+        if report['problems']:
+            failed += 1
+            print(f"❌ {report['path']}")
+            for problem in report['problems']:
+                print(f"    - {problem}")
+        else:
+            print(f"✅ {report['path']} (spine: {report['spine']}, manifest: {report['manifest']}, "
+                  f"约 {report['estimated_size']} 字节)")
+    print(f"📦 检查了 {len(reports)} 个文件，{failed} 个有问题；预计输出大小约 {total_size} 字节")
+    return 1 if failed else 0
+
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file
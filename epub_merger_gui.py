@@ -7,7 +7,7 @@ EPUB文件合并工具 - 现代化GUI版本
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
-from epub_merger import EpubMerger
+import logging
 import threading
 from datetime import datetime
 
@@ -41,205 +41,24 @@ class ModernEpubMergerGUI:
             'ko-KR': '한국어'
         }
         
-        # 界面文本字典
-        self.texts = {
-            'zh-CN': {
-                'title': '📚 EPUB文件合并工具',
-                'subtitle': '将多个EPUB文件按顺序合并，保留原有格式和内容',
-                'file_section': '📁 选择EPUB文件',
-                'output_section': '💾 输出设置',
-                'status_section': '⚡ 处理状态',
-                'add_files': '➕ 添加文件',
-                'clear_files': '🗑️ 清空列表',
-                'move_up': '⬆️ 上移',
-                'move_down': '⬇️ 下移',
-                'remove_selected': '❌ 删除选中',
-                'output_filename': '输出文件名:',
-                'select_location': '📁 选择位置',
-                'language_setting': '语言设置:',
-                'start_merge': '🚀 开始合并',
-                'merging': '⏳ 合并中...',
-                'ready': '准备就绪',
-                'select_files': '请选择要合并的EPUB文件',
-                'files_selected': '已选择 {} 个EPUB文件，准备就绪',
-                'merge_complete': '✅ 合并完成！',
-                'merge_failed': '❌ 合并失败',
-                'last_update': '最后更新: {}',
-                'warning': '警告',
-                'error': '错误',
-                'success': '成功',
-                'select_files_warning': '请先选择要合并的EPUB文件！',
-                'output_warning': '请指定输出文件名！',
-                'merge_success': 'EPUB文件合并成功！\n\n输出文件: {}',
-                'merge_error': '合并失败:\n{}',
-                'select_epub_files': '选择EPUB文件',
-                'select_output_location': '选择输出文件位置',
-                'epub_files': 'EPUB文件',
-                'all_files': '所有文件',
-                'files_count': '{} 个文件',
-                'processing': '正在合并EPUB文件...',
-                'language_code': '语言代码: {}'
-            },
-            'zh-TW': {
-                'title': '📚 EPUB檔案合併工具',
-                'subtitle': '將多個EPUB檔案按順序合併，保留原有格式和內容',
-                'file_section': '📁 選擇EPUB檔案',
-                'output_section': '💾 輸出設定',
-                'status_section': '⚡ 處理狀態',
-                'add_files': '➕ 新增檔案',
-                'clear_files': '🗑️ 清空清單',
-                'move_up': '⬆️ 上移',
-                'move_down': '⬇️ 下移',
-                'remove_selected': '❌ 刪除選中',
-                'output_filename': '輸出檔案名稱:',
-                'select_location': '📁 選擇位置',
-                'language_setting': '語言設定:',
-                'start_merge': '🚀 開始合併',
-                'merging': '⏳ 合併中...',
-                'ready': '準備就緒',
-                'select_files': '請選擇要合併的EPUB檔案',
-                'files_selected': '已選擇 {} 個EPUB檔案，準備就緒',
-                'merge_complete': '✅ 合併完成！',
-                'merge_failed': '❌ 合併失敗',
-                'last_update': '最後更新: {}',
-                'warning': '警告',
-                'error': '錯誤',
-                'success': '成功',
-                'select_files_warning': '請先選擇要合併的EPUB檔案！',
-                'output_warning': '請指定輸出檔案名稱！',
-                'merge_success': 'EPUB檔案合併成功！\n\n輸出檔案: {}',
-                'merge_error': '合併失敗:\n{}',
-                'select_epub_files': '選擇EPUB檔案',
-                'select_output_location': '選擇輸出檔案位置',
-                'epub_files': 'EPUB檔案',
-                'all_files': '所有檔案',
-                'files_count': '{} 個檔案',
-                'processing': '正在合併EPUB檔案...',
-                'language_code': '語言代碼: {}'
-            },
-            'en-US': {
-                'title': '📚 EPUB File Merger Tool',
-                'subtitle': 'Merge multiple EPUB files in sequence, preserving original format and content',
-                'file_section': '📁 Select EPUB Files',
-                'output_section': '💾 Output Settings',
-                'status_section': '⚡ Processing Status',
-                'add_files': '➕ Add Files',
-                'clear_files': '🗑️ Clear List',
-                'move_up': '⬆️ Move Up',
-                'move_down': '⬇️ Move Down',
-                'remove_selected': '❌ Delete Selected',
-                'output_filename': 'Output Filename:',
-                'select_location': '📁 Select Location',
-                'language_setting': 'Language Setting:',
-                'start_merge': '🚀 Start Merge',
-                'merging': '⏳ Merging...',
-                'ready': 'Ready',
-                'select_files': 'Please select EPUB files to merge',
-                'files_selected': '{} files selected, ready to merge',
-                'merge_complete': '✅ Merge Complete!',
-                'merge_failed': '❌ Merge Failed',
-                'last_update': 'Last Update: {}',
-                'warning': 'Warning',
-                'error': 'Error',
-                'success': 'Success',
-                'select_files_warning': 'Please select EPUB files to merge first!',
-                'output_warning': 'Please specify output filename!',
-                'merge_success': 'EPUB files merged successfully!\n\nOutput file: {}',
-                'merge_error': 'Merge failed:\n{}',
-                'select_epub_files': 'Select EPUB Files',
-                'select_output_location': 'Select Output File Location',
-                'epub_files': 'EPUB Files',
-                'all_files': 'All Files',
-                'files_count': '{} files',
-                'processing': 'Merging EPUB files...',
-                'language_code': 'Language Code: {}'
-            },
-            'ja-JP': {
-                'title': '📚 EPUBファイル結合ツール',
-                'subtitle': '複数のEPUBファイルを順番に結合し、元のフォーマットとコンテンツを保持します',
-                'file_section': '📁 EPUBファイルを選択',
-                'output_section': '💾 出力設定',
-                'status_section': '⚡ 処理状態',
-                'add_files': '➕ ファイル追加',
-                'clear_files': '🗑️ リストクリア',
-                'move_up': '⬆️ 上に移動',
-                'move_down': '⬇️ 下に移動',
-                'remove_selected': '❌ 選択削除',
-                'output_filename': '出力ファイル名:',
-                'select_location': '📁 場所選択',
-                'language_setting': '言語設定:',
-                'start_merge': '🚀 結合開始',
-                'merging': '⏳ 結合中...',
-                'ready': '準備完了',
-                'select_files': '結合するEPUBファイルを選択してください',
-                'files_selected': '{}個のファイルが選択されました、結合準備完了',
-                'merge_complete': '✅ 結合完了！',
-                'merge_failed': '❌ 結合失敗',
-                'last_update': '最終更新: {}',
-                'warning': '警告',
-                'error': 'エラー',
-                'success': '成功',
-                'select_files_warning': '結合するEPUBファイルを先に選択してください！',
-                'output_warning': '出力ファイル名を指定してください！',
-                'merge_success': 'EPUBファイルの結合が成功しました！\n\n出力ファイル: {}',
-                'merge_error': '結合に失敗しました:\n{}',
-                'select_epub_files': 'EPUBファイルを選択',
-                'select_output_location': '出力ファイルの場所を選択',
-                'epub_files': 'EPUBファイル',
-                'all_files': 'すべてのファイル',
-                'files_count': '{}個のファイル',
-                'processing': 'EPUBファイルを結合中...',
-                'language_code': '言語コード: {}'
-            },
-            'ko-KR': {
-                'title': '📚 EPUB 파일 병합 도구',
-                'subtitle': '여러 EPUB 파일을 순서대로 병합하여 원본 형식과 내용을 유지합니다',
-                'file_section': '📁 EPUB 파일 선택',
-                'output_section': '💾 출력 설정',
-                'status_section': '⚡ 처리 상태',
-                'add_files': '➕ 파일 추가',
-                'clear_files': '🗑️ 목록 지우기',
-                'move_up': '⬆️ 위로 이동',
-                'move_down': '⬇️ 아래로 이동',
-                'remove_selected': '❌ 선택 삭제',
-                'output_filename': '출력 파일명:',
-                'select_location': '📁 위치 선택',
-                'language_setting': '언어 설정:',
-                'start_merge': '🚀 병합 시작',
-                'merging': '⏳ 병합 중...',
-                'ready': '준비 완료',
-                'select_files': '병합할 EPUB 파일을 선택하세요',
-                'files_selected': '{}개 파일이 선택되었습니다, 병합 준비 완료',
-                'merge_complete': '✅ 병합 완료!',
-                'merge_failed': '❌ 병합 실패',
-                'last_update': '마지막 업데이트: {}',
-                'warning': '경고',
-                'error': '오류',
-                'success': '성공',
-                'select_files_warning': '병합할 EPUB 파일을 먼저 선택하세요!',
-                'output_warning': '출력 파일명을 지정하세요!',
-                'merge_success': 'EPUB 파일 병합이 성공했습니다!\n\n출력 파일: {}',
-                'merge_error': '병합에 실패했습니다:\n{}',
-                'select_epub_files': 'EPUB 파일 선택',
-                'select_output_location': '출력 파일 위치 선택',
-                'epub_files': 'EPUB 파일',
-                'all_files': '모든 파일',
-                'files_count': '{}개 파일',
-                'processing': 'EPUB 파일을 병합 중...',
-                'language_code': '언어 코드: {}'
-            }
-        }
+        # 当前语言的界面文本，按需加载
+        self.texts = None
+        self.texts_language = None
         
         self.epub_files = []
         self.setup_ui()
         
     def get_text(self, key):
-        """获取当前语言的文本"""
-        return self.texts.get(self.current_language, self.texts['zh-CN']).get(key, key)
+        """获取当前语言的文本，文本表在第一次使用时才加载"""
+        if self.texts is None or self.texts_language != self.current_language:
+            from epub_merger_i18n import get_texts
+            self.texts = get_texts(self.current_language)
+            self.texts_language = self.current_language
+        return self.texts.get(key, key)
         
     def change_language(self, language_code):
         """切换界面语言"""
-        if language_code in self.texts:
+        if language_code in self.languages:
             self.current_language = language_code
             self.update_ui_texts()
             
@@ -711,6 +530,8 @@ class ModernEpubMergerGUI:
             selected_index = self.language_combo.current()
             language_code = self.language_options[selected_index][1] if selected_index >= 0 else 'zh-CN'
             
+            # 合并模块在真正开始合并时才导入，加快界面启动
+            from epub_merger import EpubMerger
             merger = EpubMerger(language=language_code)
             merger.merge_epub(self.epub_files, output_path)
             
@@ -749,6 +570,7 @@ class ModernEpubMergerGUI:
             self.change_language(language_code)
 
 def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     root = tk.Tk()
     
     # 设置窗口图标（如果有的话）
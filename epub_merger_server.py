@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EPUB文件合并工具 - 常驻服务模式
+通过本地HTTP或Unix套接字接收合并任务，在工作线程池中排队执行，
+多个任务之间共享已解析的书包结构和压缩结果缓存，避免每次都重新启动解释器
+"""
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List
+
+from epub_merger import EpubMerger, MergeCache
+
+logger = logging.getLogger(__name__)
+
+# 任务中允许传给EpubMerger的选项
+JOB_OPTIONS = ('language', 'prune', 'metadata_rules', 'title', 'creators',
+               'prefetch_depth', 'prefetch_memory', 'read_workers', 'compression_level',
+               'compress_workers', 'max_output_size', 'split_every', 'consolidate_size', 'deterministic',
+               'dedupe_css', 'subset_fonts', 'keep_layout')
+
+
+class MergeJob:
+    """一个合并任务及其状态"""
+
+    def __init__(self, inputs: List[str], output: str, options: Dict):
+        self.id = uuid.uuid4().hex
+        self.inputs = inputs
+        self.output = output
+        self.options = options
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = {}
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'inputs': self.inputs,
+            'output': self.output,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'duration': (self.finished - self.started) if self.finished and self.started else None,
+            'result': self.result
+        }
+
+
+class MergeService:
+    """任务队列：在线程池中执行合并，所有任务共享同一个MergeCache
+
+    已结束的任务最多保留keep_jobs个、job_ttl秒，超出的从旧到新丢弃，常驻进程的内存不会随任务数增长。
+    """
+
+    def __init__(self, workers: int = 2, cache: MergeCache = None, keep_jobs: int = 1000,
+                 job_ttl: float = 3600):
+        self.cache = cache or MergeCache()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='merge-job')
+        # 任务ID -> MergeJob，按提交顺序
+        self.jobs = {}
+        self.keep_jobs = keep_jobs
+        self.job_ttl = job_ttl
+        self.evicted_jobs = 0
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @staticmethod
+    def check_request(inputs: List[str], options: Dict = None) -> Dict:
+        """校验输入文件列表和选项，返回选项"""
+        if not isinstance(inputs, list) or not inputs or not all(isinstance(path, str) for path in inputs):
+            raise ValueError('inputs必须是非空的文件路径列表')
+        options = options or {}
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"不支持的选项: {', '.join(sorted(unknown))}")
+        return options
+
+    def create_merger(self, options: Dict) -> EpubMerger:
+        """按任务选项创建共用缓存的合并器并检查选项组合，选项无效时抛出ValueError或TypeError"""
+        merger = EpubMerger(cache=self.cache, **options)
+        merger.check_layout_options()
+        return merger
+
+    def submit(self, inputs: List[str], output: str, options: Dict = None) -> MergeJob:
+        """校验并提交一个合并任务"""
+        options = self.check_request(inputs, options)
+        if not isinstance(output, str) or not output:
+            raise ValueError('output必须是输出文件路径')
+        self.create_merger(options)
+
+        job = MergeJob(inputs, output, options)
+        with self.lock:
+            self.evict_jobs()
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job)
+        logger.info(f"任务已排队: {job.id} ({len(inputs)} 个文件 -> {output})")
+        return job
+
+    def _run(self, job: MergeJob):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            for path in job.inputs:
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"文件不存在: {path}")
+            merger = self.create_merger(job.options)
+            outputs = merger.merge_epub(job.inputs, job.output)
+            job.result = {
+                'outputs': outputs,
+                'output_size': sum(os.path.getsize(path) for path in outputs),
+                'pruned_count': merger.pruned_count,
+                'pruned_bytes': merger.pruned_bytes,
+                'font_saved_bytes': merger.font_saved_bytes
+            }
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"任务失败: {job.id}: {e}")
+            logger.debug(traceback.format_exc())
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.evict_jobs()
+
+    def evict_jobs(self):
+        """丢弃超过保留时间或保留数量的已结束任务（持有lock时调用）"""
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        expired = len(finished) - self.keep_jobs
+        now = time.time()
+        for job in finished:
+            if expired > 0 or now - job.finished > self.job_ttl:
+                del self.jobs[job.id]
+                self.evicted_jobs += 1
+                expired -= 1
+
+    def get(self, job_id: str) -> MergeJob:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Dict]:
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def metrics(self) -> Dict:
+        """返回任务计数、耗时和缓存统计"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        durations = []
+        for job in jobs:
+            counts[job.status] += 1
+            if job.status == 'done':
+                durations.append(job.finished - job.started)
+        return {
+            'uptime': time.time() - self.started,
+            'jobs': counts,
+            'total_jobs': len(jobs),
+            'evicted_jobs': self.evicted_jobs,
+            'average_duration': sum(durations) / len(durations) if durations else None,
+            'cache': self.cache.snapshot()
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class ChunkedWriter:
+    """按HTTP/1.1分块传输编码把数据写入响应体，finish写入表示响应完整的结束块"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        if data:
+            self.stream.write(b'%x\r\n' % len(data))
+            self.stream.write(data)
+            self.stream.write(b'\r\n')
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self):
+        self.stream.write(b'0\r\n\r\n')
+        self.stream.flush()
+
+
+class MergeRequestHandler(BaseHTTPRequestHandler):
+    """合并服务的HTTP接口
+
+    POST /jobs         提交任务，JSON: {"inputs": [...], "output": "...", "options": {...}}
+    POST /merge        同步合并，边合并边把输出的EPUB作为响应体发送，JSON: {"inputs": [...], "options": {...}}
+    GET  /jobs         列出所有任务
+    GET  /jobs/<id>    查询任务状态
+    GET  /metrics      任务和缓存统计
+    """
+
+    server_version = 'EpubMerger'
+    # /merge的响应体使用分块传输编码
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix套接字没有客户端地址
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def send_json(self, status: int, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/jobs':
+            self.send_json(200, service.list())
+        elif self.path.startswith('/jobs/'):
+            job = service.get(self.path[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': '任务不存在'})
+            else:
+                self.send_json(200, job.to_dict())
+        elif self.path == '/metrics':
+            self.send_json(200, service.metrics())
+        else:
+            self.send_json(404, {'error': '未知的路径'})
+
+    def do_POST(self):
+        # 先读完请求体，保持连接时下一个请求才能从正确的位置开始解析
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        except ValueError:
+            self.close_connection = True
+            self.send_json(400, {'error': 'Content-Length无效'})
+            return
+        if self.path == '/merge':
+            self.merge_response(body)
+            return
+        if self.path != '/jobs':
+            self.send_json(404, {'error': '未知的路径'})
+            return
+        try:
+            request = json.loads(body or b'{}')
+            job = self.server.service.submit(request.get('inputs'), request.get('output'),
+                                             request.get('options'))
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, job.to_dict())
+
+    def merge_response(self, body: bytes):
+        """把合并结果作为响应体流式发送
+
+        选项在发送响应头之前检查，无效时返回400；响应体按分块传输编码发送，
+        开始发送后出错时不发送结束块并断开连接，客户端不会把不完整的输出当成完整的EPUB。
+        """
+        service = self.server.service
+        try:
+            request = json.loads(body or b'{}')
+            inputs = request.get('inputs')
+            options = service.check_request(inputs, request.get('options'))
+            if options.get('max_output_size') or options.get('split_every'):
+                raise ValueError('流式输出不支持分卷')
+            merger = service.create_merger(options)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        missing = [path for path in inputs if not os.path.exists(path)]
+        if missing:
+            self.send_json(404, {'error': f"文件不存在: {', '.join(missing)}"})
+            return
+
+        # 事先不知道输出大小，按块发送，输出直接顺序写入响应体，不经过临时文件
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/epub+zip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        stream = ChunkedWriter(self.wfile)
+        try:
+            merger.merge_epub(inputs, stream)
+            stream.finish()
+        except Exception as e:
+            self.close_connection = True
+            logger.error(f"流式合并失败: {e}")
+            logger.debug(traceback.format_exc())
+
+
+class MergeHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: MergeService):
+        super().__init__(address, MergeRequestHandler)
+        self.service = service
+
+
+class MergeUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: MergeService):
+        super().__init__(path, MergeRequestHandler)
+        self.service = service
+
+
+def create_server(service: MergeService, host: str = '127.0.0.1', port: int = 8765, socket_path: str = None):
+    """创建HTTP服务器；指定socket_path时监听Unix套接字"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return MergeUnixServer(socket_path, service)
+    return MergeHTTPServer((host, port), service)
+
+
+def serve_main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='epub_merger.py serve', description='以常驻服务模式运行EPUB合并工具')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口，0表示自动选择 (默认: 8765)')
+    parser.add_argument('--socket', dest='socket_path', help='改为监听指定路径的Unix套接字')
+    parser.add_argument('--workers', type=int, default=2, help='同时执行的合并任务数 (默认: 2)')
+    parser.add_argument('--cache-memory', type=int, default=256, metavar='MB',
+                       help='压缩结果缓存的内存上限，单位MB (默认: 256)')
+    parser.add_argument('--keep-jobs', type=int, default=1000, metavar='N',
+                       help='最多保留多少个已结束任务的状态 (默认: 1000)')
+    parser.add_argument('--job-ttl', type=float, default=3600, metavar='SECONDS',
+                       help='已结束任务的状态保留多久，单位秒 (默认: 3600)')
+    args = parser.parse_args(argv)
+
+    service = MergeService(workers=args.workers,
+                           cache=MergeCache(max_compressed_bytes=args.cache_memory * 1024 * 1024),
+                           keep_jobs=args.keep_jobs, job_ttl=args.job_ttl)
+    server = create_server(service, args.host, args.port, args.socket_path)
+    if args.socket_path:
+        print(f"🚀 合并服务已启动: unix:{args.socket_path}")
+    else:
+        print(f"🚀 合并服务已启动: http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket_path and os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    serve_main()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epub_factory import simple_epub  # noqa: E402
+
+
+@pytest.fixture
+def books(tmp_path):
+    """磁盘上的三本普通的书"""
+    paths = []
+    for number in range(1, 4):
+        path = tmp_path / f'vol{number}.epub'
+        path.write_bytes(simple_epub(f'卷{number}', chapters=number + 1, series='测试系列'))
+        paths.append(str(path))
+    return paths
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""测试用的EPUB生成函数：按给定的成员、manifest和spine在内存中构造EPUB"""
+
+import io
+import zipfile
+from html import escape
+from typing import Dict, List, Sequence, Tuple, Union
+
+CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="{opf_path}" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+
+def chapter(title: str, body: str = '', head: str = '') -> str:
+    """一个XHTML章节"""
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{escape(title)}</title>{head}</head>
+<body><h1 id="top">{escape(title)}</h1>{body}</body></html>'''
+
+
+def build_epub(files: Dict[str, Union[str, bytes]], manifest: Sequence[Tuple], spine: Sequence[str],
+               opf_path: str = 'OEBPS/content.opf', title: str = '测试书', creators: Sequence[str] = ('作者甲',),
+               series: str = None, cover: str = None) -> bytes:
+    """构造EPUB并返回其内容
+    
+    files为压缩包内路径 -> 内容；manifest为(id, href, media-type[, properties])，href按原样写入OPF
+    （只做XML转义，调用者负责URL编码）；cover为封面图片的manifest ID。
+    """
+    items = []
+    for entry in manifest:
+        item_id, href, media_type = entry[:3]
+        properties = f' properties="{escape(entry[3])}"' if len(entry) > 3 and entry[3] else ''
+        items.append(f'<item id="{escape(item_id)}" href="{escape(href)}" media-type="{media_type}"{properties}/>')
+    metadata = f'<dc:title>{escape(title)}</dc:title>'
+    metadata += ''.join(f'<dc:creator>{escape(creator)}</dc:creator>' for creator in creators)
+    metadata += f'<dc:identifier id="bookid">urn:test:{escape(title)}</dc:identifier>'
+    if series:
+        metadata += f'<meta name="calibre:series" content="{escape(series)}"/>'
+    if cover:
+        metadata += f'<meta name="cover" content="{escape(cover)}"/>'
+    opf = f'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">{metadata}</metadata>
+<manifest>{''.join(items)}</manifest>
+<spine>{''.join(f'<itemref idref="{escape(item_id)}"/>' for item_id in spine)}</spine>
+</package>'''
+    
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        zip_ref.writestr('META-INF/container.xml', CONTAINER_XML.format(opf_path=opf_path))
+        zip_ref.writestr(opf_path, opf)
+        for name, data in files.items():
+            zip_ref.writestr(name, data)
+    return output.getvalue()
+
+
+def simple_epub(title: str, chapters: int = 3, series: str = None, font: bool = False) -> bytes:
+    """普通的书：若干章节、一个样式表、每章一张图片和一个封面，章节之间互相链接；
+    font为True时再嵌入一个样式表引用的字体（内容不是真正的字体）
+    """
+    files = {'OEBPS/Styles/style.css': 'body { margin: 0; }\nh1 { background: url("../Images/bg.png"); }\n',
+             'OEBPS/Images/bg.png': b'\x89PNG bg ' + title.encode('utf-8'),
+             'OEBPS/Images/cover.jpg': b'\xff\xd8 cover ' + title.encode('utf-8')}
+    manifest: List[Tuple] = [('css', 'Styles/style.css', 'text/css'),
+                             ('bg', 'Images/bg.png', 'image/png'),
+                             ('cover', 'Images/cover.jpg', 'image/jpeg')]
+    if font:
+        files['OEBPS/Styles/style.css'] += '@font-face { font-family: "正文"; src: url("../Fonts/font.ttf"); }\n'
+        files['OEBPS/Fonts/font.ttf'] = b'\x00\x01\x00\x00' + f'font {title} '.encode('utf-8') * 64
+        manifest.append(('font', 'Fonts/font.ttf', 'application/x-font-ttf'))
+    spine = []
+    for i in range(1, chapters + 1):
+        link = f'<a href="ch{i % chapters + 1}.xhtml#top">下一章</a>'
+        files[f'OEBPS/Text/ch{i}.xhtml'] = chapter(
+            f'{title} 第{i}章', f'<p>正文 {i}</p><img src="../Images/p{i}.jpg" alt=""/>{link}',
+            '<link href="../Styles/style.css" rel="stylesheet" type="text/css"/>')
+        files[f'OEBPS/Images/p{i}.jpg'] = f'\xff\xd8 {title} {i}'.encode('utf-8')
+        manifest.append((f'c{i}', f'Text/ch{i}.xhtml', 'application/xhtml+xml'))
+        manifest.append((f'p{i}', f'Images/p{i}.jpg', 'image/jpeg'))
+        spine.append(f'c{i}')
+    return build_epub(files, manifest, spine, title=title, series=series, cover='cover')
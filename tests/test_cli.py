@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""命令行：退出状态和输出文件"""
+
+import io
+import os
+import struct
+import subprocess
+import sys
+import zipfile
+
+import epub_merger
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'epub_merger.py')
+
+
+def test_merge_succeeds(books, tmp_path):
+    output = tmp_path / 'merged.epub'
+    assert epub_merger.main(books + ['-o', str(output)]) == 0
+    with zipfile.ZipFile(output) as zip_ref:
+        assert zip_ref.testzip() is None
+
+
+def test_missing_input_fails(books, tmp_path):
+    output = tmp_path / 'merged.epub'
+    assert epub_merger.main([books[0], str(tmp_path / 'missing.epub'), '-o', str(output)]) == 1
+    assert not output.exists()
+
+
+def test_broken_input_fails(books, tmp_path):
+    broken = tmp_path / 'broken.epub'
+    broken.write_bytes(b'not a zip file')
+    output = tmp_path / 'merged.epub'
+    assert epub_merger.main([books[0], str(broken), '-o', str(output)]) == 1
+    assert not output.exists()
+
+
+def test_missing_append_target_fails(books, tmp_path):
+    assert epub_merger.main(books + ['--append-to', str(tmp_path / 'missing.epub')]) == 1
+
+
+def test_check_reports_problems(books, tmp_path):
+    broken = tmp_path / 'broken.epub'
+    broken.write_bytes(b'not a zip file')
+    assert epub_merger.main(['--check'] + books) == 0
+    assert epub_merger.main(['--check', books[0], str(broken)]) == 1
+
+
+def mark_encrypted(data: bytes, name: str) -> bytes:
+    """把压缩包中name成员的本地文件头和中央目录都标记为加密"""
+    data = bytearray(data)
+    with zipfile.ZipFile(io.BytesIO(bytes(data))) as zip_ref:
+        offset = zip_ref.getinfo(name).header_offset
+    data[offset + 6] |= 1
+    start = data.find(b'PK\x01\x02')
+    while start != -1:
+        length = struct.unpack_from('<H', data, start + 28)[0]
+        if data[start + 46:start + 46 + length] == name.encode('utf-8'):
+            data[start + 8] |= 1
+        start = data.find(b'PK\x01\x02', start + 1)
+    return bytes(data)
+
+
+def test_check_reports_encrypted_member(books, tmp_path):
+    encrypted = tmp_path / 'encrypted.epub'
+    with open(books[0], 'rb') as f:
+        encrypted.write_bytes(mark_encrypted(f.read(), 'OEBPS/Text/ch1.xhtml'))
+    report = epub_merger.EpubMerger().check_epubs([books[1], str(encrypted)])
+    assert report[0]['problems'] == []
+    assert any('ch1.xhtml' in problem for problem in report[1]['problems'])
+    assert epub_merger.main(['--check', str(encrypted)]) == 1
+
+
+def test_process_exit_status(books, tmp_path):
+    broken = tmp_path / 'broken.epub'
+    broken.write_bytes(b'not a zip file')
+    run = [sys.executable, SCRIPT, '-o', str(tmp_path / 'merged.epub')]
+    assert subprocess.run(run + books, capture_output=True).returncode == 0
+    assert subprocess.run(run + [books[0], str(broken)], capture_output=True).returncode == 1
+    assert subprocess.run(run + [str(tmp_path / 'missing.epub')], capture_output=True).returncode == 1
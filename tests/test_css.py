@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""样式表规范化和去重"""
+
+import zipfile
+
+import pytest
+
+from epub_factory import build_epub, chapter
+from epub_merger import EpubMerger
+
+
+@pytest.mark.parametrize('css, expected', [
+    ('h1 ,h2,  h3 { Color : red ; }', ['h1,h2,h3{color:red}']),
+    ('a[title="x , y"] , b  >  c { color: red }', ['a[title="x , y"],b > c{color:red}']),
+    ("a[title='a , b'],b{}", ["a[title='a , b'],b{}"]),
+    ('a[title="{ , }"] { color: red }', ['a[title="{ , }"]{color:red}']),
+    ('p::before { content: "a , b ; c" }', ['p::before{content:"a , b ; c"}']),
+    ('@media print { p , q { color : red } }', ['@media print{p,q{color:red}}']),
+    ('/* x */ p { margin: 0 } p { margin: 0 }', ['p{margin:0}']),
+    ('p { --Main-Color: red; COLOR: var(--Main-Color) }', ['p{--Main-Color:red;color:var(--Main-Color)}']),
+    # @import放到规则之后会失效，重复时保留第一个
+    ('@import url("a.css"); p { margin: 0 } @import url("a.css");', ['@import url("a.css");', 'p{margin:0}']),
+    ('@charset "utf-8"; @namespace svg url(x); p{} @charset "utf-8"; @namespace svg url(x);',
+     ['@charset "utf-8";', '@namespace svg url(x);', 'p{}']),
+])
+def test_normalize_css_statements(css, expected):
+    assert EpubMerger().normalize_css_statements(css) == expected
+
+
+def test_selector_strings_keep_stylesheets_apart(tmp_path):
+    """只有选择器字符串中的空白不同的样式表匹配不同的元素，不能共用"""
+    paths = []
+    for number, selector in enumerate(('a[title="x , y"]', 'a[title="x,y"]')):
+        files = {'OEBPS/style.css': f'{selector} {{ color: red }}',
+                 'OEBPS/ch.xhtml': chapter('章', head='<link href="style.css" rel="stylesheet"/>')}
+        path = tmp_path / f'book{number}.epub'
+        path.write_bytes(build_epub(files, [('css', 'style.css', 'text/css'),
+                                            ('ch', 'ch.xhtml', 'application/xhtml+xml')], ['ch'],
+                                    title=f'书{number}'))
+        paths.append(str(path))
+    output = tmp_path / 'merged.epub'
+    EpubMerger(dedupe_css=True).merge_epub(paths, str(output))
+    with zipfile.ZipFile(output) as zip_ref:
+        stylesheets = sorted(zip_ref.read(name).decode('utf-8') for name in zip_ref.namelist()
+                             if name.endswith('.css'))
+    assert stylesheets == ['a[title="x , y"]{color:red}\n', 'a[title="x,y"]{color:red}\n']
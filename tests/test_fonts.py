@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""字体子集化：未安装fontTools时原样写出，字体在本卷正文之后按顺序写出，裁剪结果可以重用"""
+
+import concurrent.futures
+import importlib.util
+import logging
+import zipfile
+
+import pytest
+
+import epub_merger
+from epub_factory import simple_epub
+from epub_merger import EpubMerger
+
+FIND_SPEC = importlib.util.find_spec
+
+
+@pytest.fixture
+def font_books(tmp_path):
+    """三本各自嵌入不同字体的书"""
+    paths = []
+    for number in range(1, 4):
+        path = tmp_path / f'vol{number}.epub'
+        path.write_bytes(simple_epub(f'卷{number}', font=True))
+        paths.append(str(path))
+    return paths
+
+
+def fonts_in(path: str):
+    with zipfile.ZipFile(path) as zip_ref:
+        return [(name, zip_ref.read(name)) for name in zip_ref.namelist() if name.endswith('.ttf')]
+
+
+def original_fonts(books):
+    fonts = []
+    for book in books:
+        with zipfile.ZipFile(book) as zip_ref:
+            fonts.append(zip_ref.read('OEBPS/Fonts/font.ttf'))
+    return fonts
+
+
+@pytest.fixture
+def fake_fonttools(monkeypatch):
+    """假装安装了fontTools：裁剪时只保留字体的前一半，返回每次裁剪的输入"""
+    calls = []
+
+    def subset_font(data, unicodes):
+        calls.append(data)
+        return data[:len(data) // 2]
+
+    monkeypatch.setattr(importlib.util, 'find_spec',
+                        lambda name, *args: object() if name == 'fontTools' else FIND_SPEC(name, *args))
+    monkeypatch.setattr(epub_merger, 'subset_font', subset_font)
+    # 替换的函数不能传到子进程中，改在线程中并行
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    return calls
+
+
+def test_fonts_copied_without_fonttools(font_books, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(importlib.util, 'find_spec',
+                        lambda name, *args: None if name == 'fontTools' else FIND_SPEC(name, *args))
+    output = tmp_path / 'merged.epub'
+    merger = EpubMerger(subset_fonts=True)
+    with caplog.at_level(logging.WARNING, logger=epub_merger.__name__):
+        merger.merge_epub(font_books, str(output))
+    assert any('未安装fontTools' in record.getMessage() for record in caplog.records)
+    assert [data for _, data in fonts_in(str(output))] == original_fonts(font_books)
+    assert merger.font_saved_bytes == 0
+
+
+def test_fonts_written_in_order_after_documents(font_books, tmp_path, fake_fonttools):
+    output = tmp_path / 'merged.epub'
+    merger = EpubMerger(subset_fonts=True)
+    merger.merge_epub(font_books, str(output))
+    originals = original_fonts(font_books)
+    with zipfile.ZipFile(output) as zip_ref:
+        names = zip_ref.namelist()
+    fonts = [name for name in names if name.endswith('.ttf')]
+    documents = [name for name in names if name.endswith('.xhtml') and name != 'nav.xhtml']
+    # 字体在所有正文之后、导航和OPF之前，按书的顺序写出
+    assert max(map(names.index, documents)) < min(map(names.index, fonts))
+    assert max(map(names.index, fonts)) < names.index('nav.xhtml')
+    assert [data for _, data in fonts_in(str(output))] == [data[:len(data) // 2] for data in originals]
+    assert merger.font_saved_bytes == sum(len(data) - len(data) // 2 for data in originals)
+
+
+def test_cached_subsets_reused(font_books, tmp_path, fake_fonttools):
+    merger = EpubMerger(subset_fonts=True)
+    first = tmp_path / 'first.epub'
+    merger.merge_epub(font_books, str(first))
+    assert sorted(fake_fonttools) == sorted(original_fonts(font_books))
+    saved = merger.font_saved_bytes
+
+    # 字体和正文用到的字符都没变：直接用缓存的结果，不再裁剪
+    second = tmp_path / 'second.epub'
+    merger.merge_epub(font_books, str(second))
+    assert len(fake_fonttools) == len(font_books)
+    assert fonts_in(str(second)) == fonts_in(str(first))
+    assert merger.font_saved_bytes == saved
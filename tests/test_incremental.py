@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""增量合并：重放未变的前缀，结果与完整合并相同，记录中不持有输入书的数据"""
+
+import os
+
+import pytest
+
+from epub_factory import simple_epub
+from epub_merger import EpubMerger, MergeCache
+
+OPTIONS = [{}, {'prune': True, 'dedupe_css': True}, {'split_every': 2}, {'consolidate_size': 20000}]
+
+
+def merge(merger, books, output):
+    return [open(path, 'rb').read() for path in merger.merge_epub(books, str(output))]
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_replayed_prefix_matches_full_merge(books, tmp_path, options):
+    merger = EpubMerger(deterministic=True, incremental=True, cache=MergeCache(), **options)
+    first = merge(merger, books, tmp_path / 'first.epub')
+    assert first == merge(EpubMerger(deterministic=True, **options), books, tmp_path / 'full.epub')
+
+    # 只修改最后一本书：前两本直接重放
+    with open(books[-1], 'wb') as output:
+        output.write(simple_epub('卷3（修订）', chapters=5, series='测试系列'))
+    second = merge(merger, books, tmp_path / 'second.epub')
+    assert merger.reused_books == 2
+    assert second == merge(EpubMerger(deterministic=True, **options), books, tmp_path / 'full.epub')
+
+    # 什么都没变时全部重放
+    assert merge(merger, books, tmp_path / 'third.epub') == second
+    assert merger.reused_books == 3
+
+
+@pytest.mark.parametrize('options', [{}, {'subset_fonts': True}])
+def test_recorded_members_do_not_hold_inputs(tmp_path, options):
+    books = []
+    for number in range(1, 4):
+        path = tmp_path / f'vol{number}.epub'
+        path.write_bytes(simple_epub(f'卷{number}', font=True))
+        books.append(str(path))
+    merger = EpubMerger(incremental=True, **options)
+    merger.merge_epub(books, str(tmp_path / 'merged.epub'))
+    for book in merger.processed_books.values():
+        assert all(type(member.raw) is bytes for _, member in book.members)
+    if os.path.exists('/proc/self/maps'):
+        with open('/proc/self/maps') as maps:
+            mapped = maps.read()
+        assert not any(path in mapped for path in books)
+
+
+def test_state_records_only_book_changes(books, tmp_path):
+    merger = EpubMerger(incremental=True)
+    merger.merge_epub(books, str(tmp_path / 'merged.epub'))
+    # state[3]为各容器的改动，[1]为资源映射：每本书只记录自己写入的路径
+    mappings = [book.state[3][1] for book in merger.processed_books.values()]
+    targets = [set(mapping.values()) for mapping in mappings]
+    assert all(targets)
+    assert not targets[0] & targets[1] and not targets[1] & targets[2]
+    assert len(mappings[2]) < sum(map(len, mappings))
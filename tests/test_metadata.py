@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""元数据：封面声明"""
+
+import zipfile
+from xml.dom import minidom
+
+from epub_factory import build_epub, chapter
+from epub_merger import EpubMerger
+
+
+def cover_items(path) -> list:
+    with zipfile.ZipFile(path) as zip_ref:
+        opf = minidom.parseString(zip_ref.read('content.opf'))
+    return [item.getAttribute('media-type') for item in opf.getElementsByTagName('item')
+            if 'cover-image' in item.getAttribute('properties').split()]
+
+
+def cover_epub(cover: str) -> bytes:
+    files = {'OEBPS/cover.xhtml': chapter('封面', '<img src="cover.jpg"/>'),
+             'OEBPS/cover.jpg': b'\xff\xd8 cover',
+             'OEBPS/ch.xhtml': chapter('第一章')}
+    manifest = [('cover-page', 'cover.xhtml', 'application/xhtml+xml'),
+                ('cover-image', 'cover.jpg', 'image/jpeg'),
+                ('ch', 'ch.xhtml', 'application/xhtml+xml')]
+    return build_epub(files, manifest, ['cover-page', 'ch'], cover=cover)
+
+
+def test_meta_cover_image_is_used(tmp_path):
+    source = tmp_path / 'book.epub'
+    source.write_bytes(cover_epub('cover-image'))
+    output = tmp_path / 'merged.epub'
+    EpubMerger().merge_epub([str(source)], str(output))
+    assert cover_items(output) == ['image/jpeg']
+
+
+def test_meta_cover_pointing_at_document_is_ignored(tmp_path):
+    source = tmp_path / 'book.epub'
+    source.write_bytes(cover_epub('cover-page'))
+    output = tmp_path / 'merged.epub'
+    EpubMerger().merge_epub([str(source)], str(output))
+    assert cover_items(output) == []
+    with zipfile.ZipFile(output) as zip_ref:
+        assert '<meta name="cover"' not in zip_ref.read('content.opf').decode('utf-8')
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""性能记录：cProfile结果按“阶段: 书名”归类，内存记录写入JSON且不含记录本身的开销"""
+
+import json
+import os
+import pstats
+
+import epub_merger
+from epub_merger import MergeProfiler
+
+
+def test_profile_labels_phases_and_books(books, tmp_path):
+    output = tmp_path / 'merged.epub'
+    profile = tmp_path / 'merge.prof'
+    assert epub_merger.main(books + ['-o', str(output), '--profile', str(profile)]) == 0
+    names = {name for _, _, name in pstats.Stats(str(profile)).stats}
+    for book in books:
+        assert f'读取: {os.path.basename(book)}' in names
+        assert f'处理: {os.path.basename(book)}' in names
+    assert '写出: merged.epub' in names
+
+
+def test_trace_memory_writes_records(books, tmp_path):
+    output = tmp_path / 'merged.epub'
+    memory = tmp_path / 'memory.json'
+    assert epub_merger.main(books + ['-o', str(output), '--trace-memory', str(memory)]) == 0
+    with open(memory, encoding='utf-8') as records:
+        phases = json.load(records)['phases']
+    assert [(record['phase'], record['name']) for record in phases if record['phase'] == '处理'] == [
+        ('处理', os.path.basename(book)) for book in books]
+    assert all(record['peak'] >= 0 and 'seconds' in record for record in phases)
+    # 记录本身（快照统计、各阶段的记录）的分配不出现在分配最多的位置中
+    source = os.path.normcase(os.path.abspath(epub_merger.__file__))
+    own_lines = MergeProfiler.source_lines()
+    assert own_lines
+    for record in phases:
+        for allocation in record['top_allocations']:
+            filename, _, lineno = allocation['site'].rpartition(':')
+            assert not (os.path.normcase(os.path.abspath(filename)) == source and int(lineno) in own_lines), \
+                allocation
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""改写后的引用：OPF、导航和文档中的路径都能解析到输出中实际存在的成员"""
+
+import posixpath
+import random
+import re
+import zipfile
+from html import escape, unescape
+from urllib.parse import quote, unquote
+from xml.dom import minidom
+
+import pytest
+
+from epub_factory import build_epub, chapter
+from epub_merger import EpubMerger
+
+ATTRIBUTE = re.compile(r'(?:src|href)="([^"]*)"')
+CSS_URL = re.compile(r'url\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^"\'()\s]*))\s*\)')
+# 随机文件名用到的字符：非ASCII字符、空格以及URL和XML中有特殊含义的字符
+NAME_CHARS = 'abcXYZ019 _-~图书é%#&\'()[]+;=!@$,'
+
+
+def encoded_names_epub(title: str) -> bytes:
+    """文件名含非ASCII字符、空格、#和%的书，manifest中按URL编码，文档中编码和未编码的写法都有"""
+    files = {
+        'OEBPS/Styles/style.css': 'h1 { background: url("../Images/%E5%9B%BE%201.png"); }',
+        'OEBPS/Images/图 1.png': b'\x89PNG ' + title.encode('utf-8'),
+        'OEBPS/Images/a#b.png': b'\x89PNG hash',
+        'OEBPS/Images/100%.png': b'\x89PNG percent',
+        'OEBPS/Text/第1章.xhtml': chapter(
+            title, '<img src="../Images/图 1.png"/><img src="../Images/a%23b.png"/>'
+                   '<img src="../Images/100%25.png"/><a href="%E7%AC%AC1%E7%AB%A0.xhtml#top">本章</a>',
+            '<link href="../Styles/style.css" rel="stylesheet" type="text/css"/>'),
+    }
+    manifest = [('css', 'Styles/style.css', 'text/css'),
+                ('img', 'Images/%E5%9B%BE%201.png', 'image/png'),
+                ('hash', 'Images/a%23b.png', 'image/png'),
+                ('percent', 'Images/100%25.png', 'image/png'),
+                ('c1', 'Text/%E7%AC%AC1%E7%AB%A0.xhtml', 'application/xhtml+xml')]
+    return build_epub(files, manifest, ['c1'], title=title, cover='img')
+
+
+def manifest_hrefs(zip_ref: zipfile.ZipFile):
+    opf = minidom.parseString(zip_ref.read('content.opf'))
+    return [item.getAttribute('href') for item in opf.getElementsByTagName('item')]
+
+
+def assert_references_resolve(path: str):
+    """OPF中的href和所有文档中的src、href、url()按URL解码后都指向存在的成员"""
+    with zipfile.ZipFile(path) as zip_ref:
+        names = set(zip_ref.namelist())
+        hrefs = manifest_hrefs(zip_ref)
+        assert hrefs
+        for href in hrefs:
+            assert unquote(href) in names, href
+        for href in hrefs:
+            name = unquote(href)
+            if not name.endswith(('.xhtml', '.css')):
+                continue
+            content = zip_ref.read(name).decode('utf-8')
+            refs = [''.join(groups) for groups in CSS_URL.findall(content)]
+            if name.endswith('.xhtml'):
+                refs = [unescape(ref) for ref in refs + ATTRIBUTE.findall(content)]
+            for ref in refs:
+                ref = ref.split('#')[0].split('?')[0]
+                if not ref or '://' in ref:
+                    continue
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(name), unquote(ref)))
+                assert target in names, (name, ref)
+
+
+@pytest.mark.parametrize('options', [{}, {'keep_layout': True}])
+def test_member_names_are_decoded(tmp_path, options):
+    inputs = []
+    for number in (1, 2):
+        path = tmp_path / f'vol{number}.epub'
+        path.write_bytes(encoded_names_epub(f'卷{number}'))
+        inputs.append(str(path))
+    output = tmp_path / 'merged.epub'
+    EpubMerger(**options).merge_epub(inputs, str(output))
+    with zipfile.ZipFile(output) as zip_ref:
+        names = zip_ref.namelist()
+        # 成员名是解码后的文件名，URL形式只出现在OPF和引用中
+        assert not any('%E5' in name for name in names)
+        assert any(name.endswith('图 1.png') for name in names)
+        assert any(name.endswith('100%.png') for name in names)
+        assert any('%E5%9B%BE%201.png' in href for href in manifest_hrefs(zip_ref))
+    assert_references_resolve(str(output))
+
+
+def test_appended_names_stay_decoded(tmp_path):
+    first = tmp_path / 'vol1.epub'
+    second = tmp_path / 'vol2.epub'
+    first.write_bytes(encoded_names_epub('卷1'))
+    second.write_bytes(encoded_names_epub('卷2'))
+    merged = tmp_path / 'merged.epub'
+    EpubMerger().merge_epub([str(first)], str(merged))
+    appended = tmp_path / 'appended.epub'
+    EpubMerger().append_epub(str(merged), [str(second)], str(appended))
+    with zipfile.ZipFile(appended) as zip_ref:
+        names = zip_ref.namelist()
+        assert 'resources/图 1.png' in names and 'resources/图 1_2.png' in names
+        nav = zip_ref.read('nav.xhtml').decode('utf-8')
+        assert nav.count('<li>') == 2
+    assert_references_resolve(str(appended))
+
+
+def random_name(rng: random.Random, used: set, extension: str) -> str:
+    while True:
+        name = ''.join(rng.choice(NAME_CHARS) for _ in range(rng.randint(1, 6))).strip() + extension
+        if name != extension and name.lower() not in used:
+            used.add(name.lower())
+            return name
+
+
+def random_reference(rng: random.Random, target: str, document_dir: str, css: bool = False) -> str:
+    """从document_dir中引用压缩包内的target，随机选用不同的写法"""
+    relative = posixpath.relpath(target, document_dir or '.')
+    forms = ['encoded', 'partial', 'dotdot', 'absolute']
+    if not any(char in relative for char in '%#?'):
+        forms.append('raw')
+    if not css:
+        # 样式表中的反斜杠是转义符，只在HTML属性中使用
+        forms.append('backslash')
+    form = rng.choice(forms)
+    if form == 'raw':
+        ref = relative
+    elif form == 'partial':
+        # 只编码必须编码的字符，非ASCII字符和空格保持原样
+        ref = quote(relative, safe="/ !$&'()*+,;=@~" + ''.join(set(relative) - set('%#?')))
+    elif form == 'dotdot':
+        # 先退到根目录之外再下来，超出根目录的..被忽略
+        depth = len(document_dir.split('/')) if document_dir else 0
+        ref = quote('../' * (depth + rng.randint(0, 2)) + 'x/y/../../' + target)
+    elif form == 'absolute':
+        ref = quote('/' + target)
+    elif form == 'backslash':
+        ref = quote(relative).replace('/', '\\')
+    else:
+        ref = quote(relative)
+    return ref + rng.choice(['', '', '#frag', '?v=1'])
+
+
+def adversarial_epub(seed: int) -> bytes:
+    """按seed生成目录和文件名都很刁钻的书：OPF可能在根目录或多层目录中，引用混用各种写法"""
+    rng = random.Random(seed)
+    opf_dir = rng.choice(['', 'OEBPS', 'a/b/c', '内容'])
+    directories = [opf_dir, posixpath.join(opf_dir, 'Text'), posixpath.join(opf_dir, 'Text/第一部 上'),
+                   'Images', posixpath.join(opf_dir, 'Images/图 片'), 'Styles']
+    used = set()
+    images = [posixpath.join(rng.choice(directories), random_name(rng, used, '.png')) for _ in range(8)]
+    styles = [posixpath.join(rng.choice(directories), random_name(rng, used, '.css')) for _ in range(2)]
+    chapters = [posixpath.join(rng.choice(directories), random_name(rng, used, '.xhtml')) for _ in range(5)]
+    files = {}
+    for path in images:
+        files[path] = b'\x89PNG ' + path.encode('utf-8')
+    for path in styles:
+        directory = posixpath.dirname(path)
+        rules = []
+        for image in rng.sample(images, 3):
+            ref = random_reference(rng, image, directory, css=True)
+            quote_mark = rng.choice(['"', "'"] if re.search(r'[\s"\'()]', ref) else ['"', "'", ''])
+            rules.append(f'.c{len(rules)} {{ background: url({quote_mark}{ref}{quote_mark}); }}')
+        files[path] = '\n'.join(rules)
+    for index, path in enumerate(chapters):
+        directory = posixpath.dirname(path)
+        head = ''.join(f'<link href="{escape(random_reference(rng, style, directory))}" rel="stylesheet" '
+                       f'type="text/css"/>' for style in styles)
+        head += f'<style>p {{ background: url("{escape(random_reference(rng, rng.choice(images), directory, css=True))}"); }}</style>'
+        body = ''.join(f'<img src="{escape(random_reference(rng, image, directory))}" alt=""/>'
+                       for image in rng.sample(images, 3))
+        target = chapters[(index + 1) % len(chapters)]
+        body += f'<a href="{escape(random_reference(rng, target, directory))}">下一章</a>'
+        files[path] = chapter(f'第{index + 1}章', body, head)
+    
+    def href(path):
+        return quote(posixpath.relpath(path, opf_dir or '.'), safe=rng.choice(['/', "/()'&+;=~!$,@"]))
+    
+    manifest = [(f'img{i}', href(path), 'image/png') for i, path in enumerate(images)]
+    manifest += [(f'css{i}', href(path), 'text/css') for i, path in enumerate(styles)]
+    manifest += [(f'c{i}', href(path), 'application/xhtml+xml') for i, path in enumerate(chapters)]
+    return build_epub(files, manifest, [f'c{i}' for i in range(len(chapters))],
+                      opf_path=posixpath.join(opf_dir, 'content.opf'), title=f'书{seed}', cover='img0')
+
+
+@pytest.mark.parametrize('path, base, expected', [
+    ('Images/a.png', 'OEBPS', 'OEBPS/Images/a.png'),
+    ('../Images/a.png', 'OEBPS/Text', 'OEBPS/Images/a.png'),
+    ('..\\Images\\a.png', 'OEBPS/Text', 'OEBPS/Images/a.png'),
+    ('../Images/%E5%9B%BE%201.png', 'OEBPS/Text', 'OEBPS/Images/图 1.png'),
+    ('../Images/100%25.png', 'OEBPS/Text', 'OEBPS/Images/100%.png'),
+    ('../../../../Images/a.png', 'OEBPS/Text', 'Images/a.png'),
+    ('/OEBPS/./Images//a.png', 'OEBPS/Text', 'OEBPS/Images/a.png'),
+    ('x/../a.png', '', 'a.png'),
+])
+def test_normalize_path(path, base, expected):
+    assert EpubMerger().normalize_path(path, base) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_normalize_path_inverts_random_references(seed):
+    """随机写法的引用都解析回被引用的路径"""
+    rng = random.Random(seed)
+    merger = EpubMerger()
+    directories = ['', 'OEBPS', 'OEBPS/Text', 'OEBPS/Text/第一部 上', 'a/b/c/d']
+    used = set()
+    for _ in range(50):
+        target = posixpath.join(rng.choice(directories), random_name(rng, used, '.png'))
+        document_dir = rng.choice(directories)
+        path, _, _ = merger.split_reference(random_reference(rng, target, document_dir))
+        assert merger.normalize_path(path, document_dir) == target, (path, document_dir)
+
+
+@pytest.mark.parametrize('options', [{}, {'prune': True, 'dedupe_css': True}, {'consolidate_size': 100000}])
+@pytest.mark.parametrize('seed', range(6))
+def test_adversarial_references_resolve(tmp_path, seed, options):
+    inputs = []
+    for offset in range(2):
+        path = tmp_path / f'book{offset}.epub'
+        path.write_bytes(adversarial_epub(seed * 2 + offset))
+        inputs.append(str(path))
+    output = tmp_path / 'merged.epub'
+    EpubMerger(**options).merge_epub(inputs, str(output))
+    assert_references_resolve(str(output))
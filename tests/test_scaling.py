@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""改写引用的耗时随文档大小线性增长：包括正常的文档和让正则表达式回溯的畸形输入"""
+
+import time
+
+import pytest
+
+from epub_merger import EpubMerger
+
+SCALE = 8
+# 线性时放大SCALE倍耗时约为SCALE倍，平方时间约为SCALE²倍
+MAX_RATIO = SCALE * 3
+
+MAPPING = {f'OEBPS/Images/p{i}.jpg': f'resources/p{i}.jpg' for i in range(500)}
+
+DOCUMENTS = {
+    'html': lambda n: ''.join(f'<p>正文 {i}</p><img src="../Images/p{i % 500}.jpg"/><a href="ch.xhtml#a{i}">x</a>'
+                              for i in range(n)),
+    'inline-style': lambda n: ''.join(f'<p style="background: url(\'../Images/p{i % 500}.jpg\')">x</p>'
+                                      for i in range(n)),
+    'css': lambda n: ''.join(f'.c{i} {{ background: url("../Images/p{i % 500}.jpg") }}\n' for i in range(n)),
+    'unterminated-attribute': lambda n: '<a href="' + 'x' * (n * 4),
+    'repeated-attribute-names': lambda n: 'src= ' * n,
+    'repeated-url-openings': lambda n: 'url(' * n,
+    'url-followed-by-whitespace': lambda n: 'url(' + ' ' * (n * 4),
+    'unterminated-url-quote': lambda n: 'url("' + 'a' * (n * 4),
+}
+
+
+def per_call(function, argument, number: int, repeat: int = 3) -> float:
+    """调用number次的平均耗时，取repeat轮中最快的一轮"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function(argument)
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def growth(function, small, large) -> float:
+    """large与small每次调用的耗时之比；调用次数按small校准，使每轮至少耗时约10毫秒"""
+    number = 1
+    while per_call(function, small, number, repeat=1) * number < 0.01 and number < 1 << 16:
+        number *= 2
+    return per_call(function, large, number) / per_call(function, small, number)
+
+
+@pytest.mark.parametrize('method', ['update_html_references', 'update_css_references'])
+@pytest.mark.parametrize('document', sorted(DOCUMENTS))
+def test_rewrite_is_linear(method, document):
+    merger = EpubMerger()
+    rewrite = getattr(merger, method)
+
+    def run(content):
+        # 每次用空的路径缓存，与处理新书时一样
+        merger.path_cache = {}
+        rewrite(content, 'OEBPS/Text', MAPPING, target_dir='resources')
+
+    generate = DOCUMENTS[document]
+    ratio = growth(run, generate(500), generate(500 * SCALE))
+    assert ratio < MAX_RATIO, f'{document}: 放大{SCALE}倍后耗时为{ratio:.1f}倍'
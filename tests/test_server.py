@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""常驻服务模式：在本机启动服务，通过HTTP和Unix套接字调用接口"""
+
+import http.client
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+
+import pytest
+
+from epub_merger import EpubMerger
+from epub_merger_server import MergeService, create_server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    def __init__(self, connect):
+        self.connect = connect
+
+    def request(self, method: str, path: str, body=None):
+        """发送请求，返回(状态码, 响应体)；响应为JSON时解析后返回"""
+        connection = self.connect()
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            connection.request(method, path, body=data)
+            response = connection.getresponse()
+            payload = response.read()
+            if response.getheader('Content-Type', '').startswith('application/json'):
+                payload = json.loads(payload)
+            return response.status, payload
+        finally:
+            connection.close()
+
+    def wait(self, job_id: str, timeout: float = 30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status, job = self.request('GET', f'/jobs/{job_id}')
+            assert status == 200
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+        raise TimeoutError(job_id)
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.fixture
+def service():
+    service = MergeService(workers=1)
+    yield service
+    service.shutdown()
+
+
+@pytest.fixture
+def tcp_client(service):
+    server = create_server(service, '127.0.0.1', 0)
+    serve(server)
+    host, port = server.server_address[:2]
+    yield Client(lambda: http.client.HTTPConnection(host, port, timeout=30))
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def unix_client(service):
+    if not hasattr(socket, 'AF_UNIX'):
+        pytest.skip('平台不支持Unix套接字')
+    # Unix套接字路径有长度限制，不放在pytest的临时目录里
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'merger.sock')
+    server = create_server(service, socket_path=path)
+    serve(server)
+    yield Client(lambda: UnixHTTPConnection(path))
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+    os.rmdir(directory)
+
+
+def assert_epub(data: bytes, spine_count: int):
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_ref:
+        assert zip_ref.testzip() is None
+        assert zip_ref.namelist()[0] == 'mimetype'
+        assert zip_ref.read('content.opf').decode('utf-8').count('<itemref ') == spine_count
+
+
+@pytest.mark.parametrize('client_name', ['tcp_client', 'unix_client'])
+def test_job_lifecycle(request, books, tmp_path, client_name):
+    client = request.getfixturevalue(client_name)
+    output = str(tmp_path / 'merged.epub')
+    status, job = client.request('POST', '/jobs', {'inputs': books, 'output': output,
+                                                   'options': {'prune': True}})
+    assert status == 202
+    assert job['status'] in ('queued', 'running', 'done')
+
+    job = client.wait(job['id'])
+    assert job['status'] == 'done', job['error']
+    assert job['result']['outputs'] == [output]
+    assert job['result']['output_size'] == os.path.getsize(output)
+    with open(output, 'rb') as f:
+        assert_epub(f.read(), 2 + 3 + 4)
+
+    status, jobs = client.request('GET', '/jobs')
+    assert status == 200 and [entry['id'] for entry in jobs] == [job['id']]
+    status, metrics = client.request('GET', '/metrics')
+    assert status == 200
+    assert metrics['jobs']['done'] == 1 and metrics['total_jobs'] == 1
+    assert metrics['average_duration'] is not None
+
+
+def test_failed_job_reports_error(tcp_client, books, tmp_path):
+    missing = str(tmp_path / 'missing.epub')
+    status, job = tcp_client.request('POST', '/jobs', {'inputs': [books[0], missing],
+                                                       'output': str(tmp_path / 'out.epub')})
+    assert status == 202
+    job = tcp_client.wait(job['id'])
+    assert job['status'] == 'failed' and 'missing.epub' in job['error']
+    assert tcp_client.request('GET', '/metrics')[1]['jobs']['failed'] == 1
+
+
+@pytest.mark.parametrize('body', [
+    {'inputs': [], 'output': 'out.epub'},
+    {'inputs': 'vol1.epub', 'output': 'out.epub'},
+    {'inputs': ['vol1.epub']},
+    {'inputs': ['vol1.epub'], 'output': 'out.epub', 'options': {'no_such_option': 1}},
+    {'inputs': ['vol1.epub'], 'output': 'out.epub', 'options': {'keep_layout': True, 'prune': True}},
+    {'inputs': ['vol1.epub'], 'output': 'out.epub', 'options': {'metadata_rules': 'first'}},
+])
+def test_invalid_job_is_rejected(tcp_client, body):
+    status, response = tcp_client.request('POST', '/jobs', body)
+    assert status == 400 and response['error']
+    assert tcp_client.request('GET', '/jobs')[1] == []
+
+
+def test_unknown_paths(tcp_client):
+    assert tcp_client.request('GET', '/jobs/0123')[0] == 404
+    assert tcp_client.request('GET', '/nothing')[0] == 404
+    assert tcp_client.request('POST', '/nothing', {})[0] == 404
+
+
+@pytest.mark.parametrize('client_name', ['tcp_client', 'unix_client'])
+def test_merge_streams_epub(request, books, tmp_path, client_name):
+    client = request.getfixturevalue(client_name)
+    status, data = client.request('POST', '/merge', {'inputs': books, 'options': {'deterministic': True}})
+    assert status == 200
+    assert_epub(data, 2 + 3 + 4)
+    # 与直接合并到文件的结果逐字节相同
+    expected = tmp_path / 'expected.epub'
+    EpubMerger(deterministic=True).merge_epub(books, str(expected))
+    assert data == expected.read_bytes()
+
+
+def test_merge_rejects_bad_requests(tcp_client, books, tmp_path):
+    assert tcp_client.request('POST', '/merge', {'inputs': books, 'options': {'split_every': 1}})[0] == 400
+    status, response = tcp_client.request('POST', '/merge', {'inputs': [str(tmp_path / 'missing.epub')]})
+    assert status == 404 and 'missing.epub' in response['error']
+
+
+@pytest.mark.parametrize('options', [{'keep_layout': True, 'prune': True}, {'metadata_rules': 'first'}])
+def test_merge_rejects_invalid_options_before_streaming(tcp_client, books, options):
+    status, response = tcp_client.request('POST', '/merge', {'inputs': books, 'options': options})
+    assert status == 400 and response['error']
+
+
+def test_failed_merge_stream_is_incomplete(tcp_client, books, tmp_path):
+    broken = tmp_path / 'broken.epub'
+    broken.write_bytes(b'not a zip file')
+    # 合并在发送响应头之后才失败：没有结束块，客户端读到的是不完整的响应
+    with pytest.raises(http.client.IncompleteRead):
+        tcp_client.request('POST', '/merge', {'inputs': [books[0], str(broken)]})
+
+
+def test_connection_is_reused_after_merge(tcp_client, books):
+    connection = tcp_client.connect()
+    try:
+        for _ in range(2):
+            connection.request('POST', '/merge', body=json.dumps({'inputs': books}).encode('utf-8'))
+            response = connection.getresponse()
+            assert response.status == 200
+            assert response.getheader('Transfer-Encoding') == 'chunked'
+            assert_epub(response.read(), 2 + 3 + 4)
+        connection.request('GET', '/metrics')
+        assert connection.getresponse().status == 200
+    finally:
+        connection.close()
+
+
+def wait_done(job, timeout: float = 30):
+    deadline = time.time() + timeout
+    while job.finished is None:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_finished_jobs_are_evicted_by_count(service, books, tmp_path):
+    service.keep_jobs = 2
+    jobs = []
+    for number in range(4):
+        jobs.append(service.submit(books[:1], str(tmp_path / f'out{number}.epub')))
+        wait_done(jobs[-1])
+    assert all(job.status == 'done' for job in jobs)
+    assert [job['id'] for job in service.list()] == [job.id for job in jobs[2:]]
+    assert service.get(jobs[0].id) is None
+    assert service.metrics()['evicted_jobs'] == 2
+
+
+def test_finished_jobs_are_evicted_by_age(service, books, tmp_path):
+    service.job_ttl = 60
+    old = service.submit(books[:1], str(tmp_path / 'old.epub'))
+    wait_done(old)
+    assert service.get(old.id) is old
+    old.finished -= 120
+    new = service.submit(books[:1], str(tmp_path / 'new.epub'))
+    wait_done(new)
+    assert service.get(old.id) is None
+    assert service.get(new.id) is new
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""监视模式：扫描目录时排除输出文件，扫描期间被删除的文件不影响监视"""
+
+import os
+
+from epub_merger import FolderWatcher
+
+
+def touch(directory, *names):
+    for name in names:
+        (directory / name).write_bytes(b'epub')
+
+
+def test_scan_excludes_output_parts(tmp_path):
+    touch(tmp_path, 'vol1.epub', 'vol2.epub', 'merged.epub', 'merged_1.epub', 'merged_12.epub',
+          'merged.partial.epub', 'merged.partial_2.epub', 'merged_notes.epub', 'notes.txt')
+    watcher = FolderWatcher(str(tmp_path), exclude_patterns=[FolderWatcher.output_pattern(
+        str(tmp_path / 'merged.epub'))])
+    names = sorted(os.path.basename(path) for path in watcher.scan())
+    assert names == ['merged_notes.epub', 'vol1.epub', 'vol2.epub']
+
+
+class VanishedEntry:
+    """扫描到之后、取文件信息之前被删除的文件"""
+    name = 'gone.epub'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.name)
+
+    def is_file(self):
+        return True
+
+    def stat(self):
+        raise FileNotFoundError(self.path)
+
+
+def test_scan_skips_files_deleted_during_scan(tmp_path, monkeypatch):
+    touch(tmp_path, 'vol1.epub')
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: list(scandir(path)) + [VanishedEntry(path)])
+    watcher = FolderWatcher(str(tmp_path))
+    assert [os.path.basename(path) for path in watcher.scan()] == ['vol1.epub']